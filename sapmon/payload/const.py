@@ -18,15 +18,72 @@ TIME_FORMAT_LOG_ANALYTICS = "%a, %d %b %Y %H:%M:%S GMT"
 TIME_FORMAT_JSON          = "%Y-%m-%dT%H:%M:%S.%fZ"
 TIME_FORMAT_HANA          = "%Y-%m-%d %H:%M:%S.%f"
 
+# State file format (version 2 tags datetime values explicitly)
+STATE_FORMAT_VERSION      = 2
+JSON_TAG_DATETIME         = "$datetime"
+
+# Keys and settings of the state store
+STATE_KEY_GLOBAL          = "global"
+STATE_KEY_CHECK           = "checks/%s"
+STATE_STORE_TIMEOUT_SECS  = 30
+
+# Size (in bytes) of the digest used to detect unchanged check results
+RESULT_DIGEST_SIZE        = 16
+ROW_FINGERPRINT_SIZE      = 8
+
+# Interval of full snapshots for checks that only ingest changed rows
+DEFAULT_DELTA_FULL_SNAPSHOT_SECS = 86400
+
 # Trace levels
 DEFAULT_CONSOLE_TRACE_LEVEL = logging.DEBUG
 DEFAULT_FILE_TRACE_LEVEL    = logging.INFO
 DEFAULT_QUEUE_TRACE_LEVEL   = logging.DEBUG
 
+# Max size of payloads (e.g. result sets) included in trace records
+DEFAULT_TRACE_PAYLOAD_MAX_BYTES = 1000
+
+# Asynchronous storage queue logging (queue messages are limited to 64 KB, including encoding overhead)
+QUEUE_LOG_MAX_PENDING_RECORDS = 10000
+QUEUE_LOG_DEBUG_DROP_RATIO    = 0.8
+QUEUE_LOG_MAX_MESSAGE_BYTES   = 48 * 1024
+QUEUE_LOG_FLUSH_SECS          = 5
+QUEUE_LOG_FLUSH_TIMEOUT_SECS  = 10
+ANALYTICS_MAX_PENDING_RECORDS = 20000
+
 # Config parameters
 CONFIG_SECTION_GLOBAL = "-global-"
 METHODNAME_ACTION     = "_action%s"
 
+# Daemon mode
+DEFAULT_CONFIG_REFRESH_SECS = 300
+MIN_CHECK_FREQUENCY_SECS    = 1
+SCHEDULER_JITTER_RATIO      = 0.25
+SCHEDULER_MAX_JITTER_SECS   = 30
+
+# HTTP connection pooling and retries
+HTTP_POOL_CONNECTIONS     = 10
+HTTP_POOL_MAXSIZE         = 10
+HTTP_RETRIES              = 3
+HTTP_RETRY_BACKOFF_FACTOR = 0.5
+HTTP_RETRY_STATUS_CODES   = (429, 500, 502, 503, 504)
+
+# Log Analytics ingestion (Data Collector API accepts at most 30 MB per post)
+LOG_ANALYTICS_MAX_POST_BYTES = 25 * 1024 * 1024
+LOG_ANALYTICS_FLUSH_BYTES    = 4 * 1024 * 1024
+LOG_ANALYTICS_FLUSH_SECS     = 10
+
+# KeyVault access (secrets are also kept in an encrypted local cache, used while the KeyVault is unavailable)
+KEYVAULT_MAX_PARALLEL_FETCHES  = 8
+KEYVAULT_SECRET_CACHE_TTL_SECS = 24 * 3600
+FILENAME_SECRET_CACHE_KEY      = "secrets.key"
+
+# Credential cache (IMDS tokens and storage account keys, refreshed in the background before they expire)
+FILENAME_CREDENTIAL_CACHE      = "credentials.cache"
+CREDENTIAL_MIN_VALIDITY_SECS   = 60
+CREDENTIAL_REFRESH_MARGIN_SECS = 10 * 60
+CREDENTIAL_REFRESH_CHECK_SECS  = 60
+STORAGE_KEY_CACHE_SECS         = 3600
+
 # Naming conventions for generated resources
 KEYVAULT_NAMING_CONVENTION               = "sapmon-kv-%s"
 STORAGE_ACCOUNT_NAMING_CONVENTION        = "sapmonsto%s"
@@ -1,18 +1,19 @@
 # Azure modules
-from azure.common.credentials import BasicTokenAuthentication
-from azure.mgmt.storage import StorageManagementClient
-from azure.identity import ManagedIdentityCredential
-from azure.keyvault.secrets import SecretClient
+from cryptography.fernet import Fernet, InvalidToken
 
 # Python modules
 import base64
+from concurrent.futures import ThreadPoolExecutor
+import gzip
 import hashlib
 import hmac
 import json
 import logging
-import requests
+import os
 import sys
-from typing import Callable, Dict, Optional, Tuple
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
 
 # Payload modules
 from const import *
@@ -20,6 +21,129 @@ from helper.tools import *
 
 ###############################################################################
 
+# Get the key to encrypt local caches of secrets and credentials (created with owner-only permissions)
+def _getLocalCacheKey() -> bytes:
+   filename = os.path.join(PATH_STATE, FILENAME_SECRET_CACHE_KEY)
+   try:
+      with open(filename, "rb") as file:
+         return file.read()
+   except FileNotFoundError:
+      key = Fernet.generate_key()
+      fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+      with os.fdopen(fd, "wb") as file:
+         file.write(key)
+      return key
+
+# Write JSON-serializable data into an encrypted local cache file (atomically, with owner-only permissions)
+def writeEncryptedCache(filename: str,
+                        data: object) -> None:
+   token = Fernet(_getLocalCacheKey()).encrypt(json.dumps(data).encode("utf-8"))
+   tempFilename = "%s.%d.tmp" % (filename, os.getpid())
+   fd = os.open(tempFilename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+   with os.fdopen(fd, "wb") as file:
+      file.write(token)
+   os.replace(tempFilename, filename)
+
+# Read data from an encrypted local cache file (raises InvalidToken if it is older than ttl or has been tampered with)
+def readEncryptedCache(filename: str,
+                       ttl: Optional[int] = None) -> object:
+   with open(filename, "rb") as file:
+      token = file.read()
+   return json.loads(Fernet(_getLocalCacheKey()).decrypt(token,
+                                                          ttl = ttl))
+
+###############################################################################
+
+# Process-wide cache of credentials (IMDS tokens and storage account keys), shared by tracing and context
+# Credentials are used until they expire and are refreshed by a background thread shortly before that;
+# consumers read them through the cache on every use, so they always get the refreshed credential.
+# Tokens are also kept in an encrypted local cache, so subsequent runs don't need to fetch them again
+# (credentials that don't expire by themselves, like storage account keys, are only kept in memory)
+class AzureCredentialCache(metaclass=Singleton):
+   def __init__(self):
+      self.tracer = None
+      self.lock = threading.Lock()
+      self.credentials = None
+      self.fetchers = {}
+      self.volatileKeys = set()
+      self.refreshThread = None
+      self.filename = os.path.join(PATH_STATE, FILENAME_CREDENTIAL_CACHE)
+
+   # Get a credential from the cache, or fetch it if it is missing or about to expire
+   # fetch() returns a tuple of the (JSON-serializable) credential and its expiry time (epoch seconds)
+   def get(self,
+           tracer: logging.Logger,
+           key: str,
+           fetch: Callable[[], Tuple[object, float]],
+           persist: bool = True) -> object:
+      with self.lock:
+         self.tracer = tracer
+         self.fetchers[key] = fetch
+         if not persist:
+            self.volatileKeys.add(key)
+         if self.credentials is None:
+            self.credentials = self._readCache()
+         (value, expiresOn) = self.credentials.get(key, (None, 0))
+         if not self.refreshThread:
+            self.refreshThread = threading.Thread(target = self._refreshPeriodically,
+                                                  name = "CredentialRefresh",
+                                                  daemon = True)
+            self.refreshThread.start()
+      if expiresOn - time.time() > CREDENTIAL_MIN_VALIDITY_SECS:
+         return value
+      return self._fetch(key, fetch)
+
+   # Fetch a credential and store it in the cache
+   def _fetch(self,
+              key: str,
+              fetch: Callable[[], Tuple[object, float]]) -> object:
+      (value, expiresOn) = fetch()
+      with self.lock:
+         self.credentials[key] = (value, float(expiresOn))
+         self._writeCache()
+      return value
+
+   # Background loop refreshing all credentials that are about to expire (starting right away, so credentials
+   # read from the local cache are also refreshed by short-lived runs)
+   # A failed refresh is retried in the next iteration; the old credential stays valid until it expires
+   def _refreshPeriodically(self) -> None:
+      while True:
+         with self.lock:
+            now = time.time()
+            dueKeys = [key for (key, (_, expiresOn)) in self.credentials.items() \
+               if key in self.fetchers and expiresOn - now <= CREDENTIAL_REFRESH_MARGIN_SECS]
+         for key in dueKeys:
+            self.tracer.info("refreshing credential %s" % key)
+            try:
+               self._fetch(key, self.fetchers[key])
+            except Exception as e:
+               self.tracer.warning("could not refresh credential %s (%s)" % (key, e))
+         time.sleep(CREDENTIAL_REFRESH_CHECK_SECS)
+
+   # Read all credentials that have not expired yet from the encrypted local cache
+   def _readCache(self) -> Dict[str, Tuple[object, float]]:
+      try:
+         credentials = readEncryptedCache(self.filename)
+      except FileNotFoundError:
+         return {}
+      except Exception as e:
+         self.tracer.warning("could not read local credential cache %s (%s)" % (self.filename,
+                                                                               e))
+         return {}
+      now = time.time()
+      return {key: (value, expiresOn) for (key, (value, expiresOn)) in credentials.items() if expiresOn > now}
+
+   # Write all credentials that may be persisted into the encrypted local cache
+   def _writeCache(self) -> None:
+      try:
+         writeEncryptedCache(self.filename,
+                             {key: entry for (key, entry) in self.credentials.items() if key not in self.volatileKeys})
+      except Exception as e:
+         self.tracer.warning("could not write local credential cache %s (%s)" % (self.filename,
+                                                                                e))
+
+###############################################################################
+
 # Provide access to Azure Instance Metadata Service (IMDS) inside the collector VM
 class AzureInstanceMetadataService:
    uri = "http://169.254.169.254/metadata"
@@ -57,24 +181,36 @@ class AzureInstanceMetadataService:
          tracer.error("could not obtain instance metadata (%s)" % e)
       return computeInstance
 
-   # Get an authentication token via IMDS
+   # Get an authentication token via IMDS (tokens are cached until shortly before they expire)
    @staticmethod
    def getAuthToken(tracer: logging.Logger,
                     resource: Optional[str] = None,
                     msiClientId: Optional[str] = None) -> Tuple[str, str]:
-      tracer.info("getting auth token for resource=%s%s" % (resource, ", msiClientId=%s" % msiClientId if msiClientId else ""))
-      authToken = None
+      try:
+         return AzureInstanceMetadataService.getCachedAuthToken(tracer,
+                                                                resource,
+                                                                msiClientId)
+      except Exception as e:
+         tracer.critical("could not get auth token (%s)" % e)
+         sys.exit(ERROR_GETTING_AUTH_TOKEN)
+
+   # Get an authentication token via IMDS from the credential cache (raises an exception if that fails)
+   @staticmethod
+   def getCachedAuthToken(tracer: logging.Logger,
+                          resource: Optional[str] = None,
+                          msiClientId: Optional[str] = None) -> Tuple[str, str]:
       if not resource:
          resource = AzureInstanceMetadataService.resource
-      try:
+      def fetchAuthToken() -> Tuple[List[str], float]:
+         tracer.info("getting auth token for resource=%s%s" % (resource, ", msiClientId=%s" % msiClientId if msiClientId else ""))
          result = AzureInstanceMetadataService._sendRequest(tracer,
                                                             "identity/oauth2/token",
                                                             params = {"resource": resource, "client_id": msiClientId})
-         authToken, msiClientId = result["access_token"], result["client_id"]
-      except Exception as e:
-         tracer.critical("could not get auth token (%s)" % e)
-         sys.exit(ERROR_GETTING_AUTH_TOKEN)
-      return authToken, msiClientId
+         return ([result["access_token"], result["client_id"]], float(result["expires_on"]))
+      (authToken, clientId) = AzureCredentialCache().get(tracer,
+                                                         "authToken|%s|%s" % (resource, msiClientId),
+                                                         fetchAuthToken)
+      return authToken, clientId
 
 ###############################################################################
 
@@ -85,6 +221,13 @@ class AzureKeyVault:
    token = None
    tracer = None
    uri = None
+   secretVersions = None
+
+   # Credentials and clients are shared by all objects of the same KeyVault (and managed identity);
+   # downloaded secrets are kept per KeyVault, so unchanged secret versions are not downloaded again
+   clients = {}
+   downloadedSecrets = {}
+   clientsLock = threading.Lock()
 
    def __init__(self,
                 tracer: logging.Logger,
@@ -94,8 +237,16 @@ class AzureKeyVault:
       self.tracer.info("initializing KeyVault %s" % kvName)
       self.kvName = kvName
       self.uri = "https://%s.vault.azure.net" % kvName
-      self.token = ManagedIdentityCredential(client_id = msiClientId)
-      self.kv_client = SecretClient(vault_url=self.uri, credential = self.token)
+      with AzureKeyVault.clientsLock:
+         if (kvName, msiClientId) not in AzureKeyVault.clients:
+            # Imported on first use (the Azure SDK modules take a while to load)
+            from azure.identity import ManagedIdentityCredential
+            from azure.keyvault.secrets import SecretClient
+            token = ManagedIdentityCredential(client_id = msiClientId)
+            AzureKeyVault.clients[(kvName, msiClientId)] = (token,
+                                                            SecretClient(vault_url=self.uri, credential = token))
+         (self.token, self.kv_client) = AzureKeyVault.clients[(kvName, msiClientId)]
+         self.secretVersions = AzureKeyVault.downloadedSecrets.setdefault(kvName, {})
 
    # Set a secret in the KeyVault
    def setSecret(self,
@@ -133,16 +284,68 @@ class AzureKeyVault:
          self.tracer.error("could not get KeyVault secret for secretId=%s (%s)" % (secretId, e))
       return secret
 
+   # Get the value of a secret, unless the same version has already been downloaded
+   def _getSecretValue(self,
+                       secretProperties) -> str:
+      cachedVersion = self.secretVersions.get(secretProperties.name, None)
+      if cachedVersion and cachedVersion[0] == secretProperties.version and cachedVersion[1] == secretProperties.updated_on:
+         return cachedVersion[2]
+      self.tracer.debug("downloading KeyVault secret %s (version=%s)" % (secretProperties.name,
+                                                                         secretProperties.version))
+      value = self.kv_client.get_secret(secretProperties.name).value
+      self.secretVersions[secretProperties.name] = (secretProperties.version, secretProperties.updated_on, value)
+      return value
+
    # Get the current versions of all secrets inside the customer KeyVault
+   # Secrets are downloaded in parallel; if the KeyVault cannot be accessed, the local secret cache is used
    def getCurrentSecrets(self) -> Dict[str, str]:
       self.tracer.info("getting current KeyVault secrets")
       secrets = {}
       try:
-         kvSecrets = self.kv_client.list_properties_of_secrets()
-         for k in kvSecrets:
-            secrets[k.name] = self.kv_client.get_secret(k.name).value
+         kvSecrets = list(self.kv_client.list_properties_of_secrets())
+         with ThreadPoolExecutor(max_workers = max(min(len(kvSecrets), KEYVAULT_MAX_PARALLEL_FETCHES), 1),
+                                 thread_name_prefix = "keyvault") as executor:
+            for (k, value) in zip(kvSecrets, executor.map(self._getSecretValue, kvSecrets)):
+               secrets[k.name] = value
       except Exception as e:
          self.tracer.error("could not get current KeyVault secrets (%s)" % e)
+         cachedSecrets = self._readSecretCache()
+         return cachedSecrets if cachedSecrets is not None else secrets
+
+      # Forget secrets that have been deleted
+      for secretName in list(self.secretVersions.keys()):
+         if secretName not in secrets:
+            self.secretVersions.pop(secretName, None)
+      self._writeSecretCache(secrets)
+      return secrets
+
+   # Store all secrets in an encrypted local cache (used while the KeyVault cannot be accessed)
+   def _writeSecretCache(self,
+                         secrets: Dict[str, str]) -> None:
+      filename = os.path.join(PATH_STATE, "%s.secrets.cache" % self.kvName)
+      try:
+         writeEncryptedCache(filename, secrets)
+      except Exception as e:
+         self.tracer.warning("could not write local secret cache %s (%s)" % (filename,
+                                                                            e))
+
+   # Read all secrets from the encrypted local cache, unless the cache has expired
+   def _readSecretCache(self) -> Optional[Dict[str, str]]:
+      filename = os.path.join(PATH_STATE, "%s.secrets.cache" % self.kvName)
+      try:
+         secrets = readEncryptedCache(filename,
+                                      ttl = KEYVAULT_SECRET_CACHE_TTL_SECS)
+      except FileNotFoundError:
+         return None
+      except InvalidToken:
+         self.tracer.error("local secret cache %s has expired or is invalid" % filename)
+         return None
+      except Exception as e:
+         self.tracer.error("could not read local secret cache %s (%s)" % (filename,
+                                                                         e))
+         return None
+      self.tracer.warning("using %d secrets from local secret cache %s" % (len(secrets),
+                                                                          filename))
       return secrets
 
    # Check if a KeyVault with a specified name exists
@@ -160,7 +363,56 @@ class AzureKeyVault:
 
 ###############################################################################
 
+# Records buffered for one custom log (and time-generated field) until they are ingested
+class LogAnalyticsBatch:
+   def __init__(self):
+      self.records = []
+      self.size = 0
+      self.createdTime = time.monotonic()
+      self.confirmations = []
+
+   # Add one JSON-encoded record to the batch
+   def append(self,
+              record: bytes,
+              confirmation: "LogAnalyticsConfirmation" = None) -> None:
+      self.records.append(record)
+      self.size += len(record) + 1
+      if confirmation and (not self.confirmations or self.confirmations[-1] is not confirmation):
+         confirmation.addBatch()
+         self.confirmations.append(confirmation)
+
+# Tracks the batches that the records of one ingestRecords call have been buffered in,
+# and reports whether all of them have been posted successfully once the last one has been posted
+class LogAnalyticsConfirmation:
+   def __init__(self,
+                tracer: logging.Logger,
+                onIngested: Callable[[bool], None]):
+      self.tracer = tracer
+      self.onIngested = onIngested
+      self.pendingBatches = 1 # released by ingestRecords once all records have been buffered
+      self.success = True
+      self.lock = threading.Lock()
+
+   # Register one more batch that contains records of this call
+   def addBatch(self) -> None:
+      with self.lock:
+         self.pendingBatches += 1
+
+   # Release one batch (or the ingestRecords call itself); the callback is invoked once all are released
+   def release(self,
+               success: bool) -> None:
+      with self.lock:
+         self.success = self.success and success
+         self.pendingBatches -= 1
+         if self.pendingBatches > 0:
+            return
+      try:
+         self.onIngested(self.success)
+      except Exception as e:
+         self.tracer.error("could not confirm ingestion into Log Analytics (%s)" % e)
+
 # Provide access to an Azure Log Analytics Workspace
+# Records are buffered per custom log and ingested in batches once they reach flushBytes or flushSecs
 class AzureLogAnalytics:
    sharedKey = None
    tracer = None
@@ -170,27 +422,122 @@ class AzureLogAnalytics:
    def __init__(self,
                 tracer: logging.Logger,
                 workspaceId: str,
-                sharedKey: str):
+                sharedKey: str,
+                compress: bool = False,
+                flushBytes: int = LOG_ANALYTICS_FLUSH_BYTES,
+                flushSecs: float = LOG_ANALYTICS_FLUSH_SECS,
+                maxPostBytes: int = LOG_ANALYTICS_MAX_POST_BYTES):
       self.tracer = tracer
       self.tracer.info("initializing Log Analytics instance")
       self.workspaceId = workspaceId
       self.sharedKey = sharedKey
       self.uri = "https://%s.ods.opinsights.azure.com/api/logs?api-version=2016-04-01" % workspaceId
+      self.compress = compress
+      self.flushBytes = min(flushBytes, maxPostBytes)
+      self.flushSecs = flushSecs
+      self.maxPostBytes = maxPostBytes
+      self.batches = {}
+      self.lock = threading.Lock()
+      self.stopEvent = threading.Event()
+      self.flushThread = None
+
+   # Buffer JSON-encoded records for ingestion into a custom log
+   # (once the instance has been closed, records are posted right away, as there is no background flush anymore)
+   # If given, onIngested is called once all records have been posted, with whether all of them were ingested
+   def ingestRecords(self,
+                     customLog: str,
+                     records: List[str],
+                     colTimeGenerated: str = None,
+                     onIngested: Optional[Callable[[bool], None]] = None) -> None:
+      self.tracer.info("buffering %d records for Log Analytics, custom log %s" % (len(records), customLog))
+      key = (customLog, colTimeGenerated)
+      fullBatches = []
+      confirmation = LogAnalyticsConfirmation(self.tracer, onIngested) if onIngested else None
+      recordsDropped = False
+      with self.lock:
+         for record in records:
+            record = record.encode("utf-8")
+            if len(record) + 2 > self.maxPostBytes:
+               self.tracer.error("dropping record of %d bytes for custom log %s (exceeds max post size)" % (len(record),
+                                                                                                          customLog))
+               recordsDropped = True
+               continue
+            batch = self.batches.setdefault(key, LogAnalyticsBatch())
+            batch.append(record, confirmation)
+            if batch.size >= self.flushBytes:
+               fullBatches.append(self.batches.pop(key))
+         if self.stopEvent.is_set():
+            if key in self.batches:
+               fullBatches.append(self.batches.pop(key))
+         elif not self.flushThread:
+            self.flushThread = threading.Thread(target = self._flushPeriodically,
+                                                name = "LogAnalyticsFlush",
+                                                daemon = True)
+            self.flushThread.start()
+      for batch in fullBatches:
+         self._postBatch(customLog, colTimeGenerated, batch)
+      if confirmation:
+         confirmation.release(not recordsDropped)
+
+   # Ingest all batches that are older than flushSecs (or all of them, if requested)
+   def flush(self,
+             force: bool = True) -> None:
+      now = time.monotonic()
+      with self.lock:
+         dueKeys = [key for (key, batch) in self.batches.items() if force or now - batch.createdTime >= self.flushSecs]
+         dueBatches = [(key, self.batches.pop(key)) for key in dueKeys]
+      for ((customLog, colTimeGenerated), batch) in dueBatches:
+         self._postBatch(customLog, colTimeGenerated, batch)
+
+   # Background loop flushing batches that have reached their max age
+   def _flushPeriodically(self) -> None:
+      while not self.stopEvent.wait(min(self.flushSecs, 1)):
+         try:
+            self.flush(force = False)
+         except Exception as e:
+            self.tracer.error("could not flush telemetry to Log Analytics (%s)" % e)
+
+   # Flush all buffered records and stop the background flush
+   def close(self) -> None:
+      self.stopEvent.set()
+      self.flush()
+
+   # Post a batch, split into as many requests as needed to stay below the max post size
+   # (then confirm the ingestion to the callers whose records were part of this batch)
+   def _postBatch(self,
+                  customLog: str,
+                  colTimeGenerated: str,
+                  batch: LogAnalyticsBatch) -> None:
+      success = True
+      chunk = []
+      chunkSize = 2
+      for record in batch.records:
+         if chunk and chunkSize + len(record) + 1 > self.maxPostBytes:
+            success = self._post(customLog, colTimeGenerated, chunk, chunkSize) is not None and success
+            chunk = []
+            chunkSize = 2
+         chunk.append(record)
+         chunkSize += len(record) + 1
+      if chunk:
+         success = self._post(customLog, colTimeGenerated, chunk, chunkSize) is not None and success
+      for confirmation in batch.confirmations:
+         confirmation.release(success)
 
    # Ingest JSON content as custom log via Log Analytics Data Collector API
    # https://docs.microsoft.com/en-us/azure/azure-monitor/platform/data-collector-api
-   def ingest(self,
-              customLog: str,
-              jsonData: str,
-              colTimeGenerated: str = None) -> bytes:
+   def _post(self,
+             customLog: str,
+             colTimeGenerated: str,
+             records: List[bytes],
+             size: int) -> bytes:
       # Sign the content as required by Data Collector API
-      def buildSig(content: str,
+      def buildSig(contentLength: int,
                    timestamp: str) -> str:
          stringHash  = """POST
 %d
 application/json
 x-ms-date:%s
-/api/logs""" % (len(content), timestamp)
+/api/logs""" % (contentLength, timestamp)
          bytesHash = bytes(stringHash, encoding="utf-8")
          decodedKey = base64.b64decode(self.sharedKey)
          encodedHash = base64.b64encode(hmac.new(decodedKey,
@@ -200,30 +547,43 @@ x-ms-date:%s
          return "SharedKey %s:%s" % (self.workspaceId, stringHash)
 
       self.tracer.info("ingesting telemetry into Log Analytics, custom log %s" % customLog)
+      body = b"[" + b",".join(records) + b"]"
+      if self.compress:
+         body = gzip.compress(body)
 
       # Log Analytics expects a specific time format
       timestamp = datetime.utcnow().strftime(TIME_FORMAT_LOG_ANALYTICS)
       headers = {
          "content-type":  "application/json",
-         "Authorization": buildSig(jsonData, timestamp),
+         "Authorization": buildSig(len(body), timestamp),
          "Log-Type":      customLog,
          "x-ms-date":     timestamp
       }
+      if self.compress:
+         headers["Content-Encoding"] = "gzip"
       # Only set the time-generated-field header if colTimeGenerated was provided
       if colTimeGenerated:
         headers["time-generated-field"] = colTimeGenerated
 
       response = None
       # Ingest the actual content via Data Collector API
+      startTime = time.time()
       try:
          response = REST.sendRequest(self.tracer,
                                      self.uri,
-                                     method = requests.post,
+                                     method = "POST",
                                      headers = headers,
-                                     data = jsonData)
+                                     data = body)
       except Exception as e:
          self.tracer.error("could not ingest telemetry into Log Analytics (%s)" % e)
-
+      latencyMs = (time.time() - startTime) * 1000
+      outcome = "ingested" if response is not None else "failed to ingest"
+      self.tracer.info("%s %d records (%d bytes, %d bytes sent) into custom log %s in %.0fms" % (outcome,
+                                                                                                 len(records),
+                                                                                                 size,
+                                                                                                 len(body),
+                                                                                                 customLog,
+                                                                                                 latencyMs))
       return response
 
 ###############################################################################
@@ -234,36 +594,50 @@ class AzureStorageQueue():
     name = None
     resourceGroup = None
     subscriptionId = None
-    token = {}
+    msiClientId = None
     tracer = None
 
     # Retrieve the name of the storage account and storage queue
     def __init__(self,
                  tracer: logging.Logger,
                  sapmonId: str,
-                 authToken: str,
                  subscriptionId: str,
                  resourceGroup: str,
-                 queueName: str):
+                 queueName: str,
+                 msiClientId: Optional[str] = None):
         self.tracer = tracer
         self.tracer.info("initializing Storage Queue instance")
         self.accountName = STORAGE_ACCOUNT_NAMING_CONVENTION % sapmonId
         self.name = queueName
         
-        self.token["access_token"] = authToken
+        self.msiClientId = msiClientId
         self.subscriptionId = subscriptionId
         self.resourceGroup = resourceGroup
 
     # Get the access key to the storage queue
+    # (the key is cached in memory per storage account, so all queues of the account share a single list_keys call)
     def getAccessKey(self) -> str:
+        return AzureCredentialCache().get(self.tracer,
+                                          "storageKey|%s|%s|%s" % (self.subscriptionId,
+                                                                   self.resourceGroup,
+                                                                   self.accountName),
+                                          self._fetchAccessKey,
+                                          persist = False)
+
+    # Retrieve the access key from the storage account via ARM (using the current auth token)
+    def _fetchAccessKey(self) -> Tuple[str, float]:
         self.tracer.info("getting access key for Storage Queue")
-        storageclient = StorageManagementClient(credentials = BasicTokenAuthentication(self.token),
+        (authToken, _) = AzureInstanceMetadataService.getCachedAuthToken(self.tracer,
+                                                                         msiClientId = self.msiClientId)
+        # Imported on first use (only needed when the access key is not cached)
+        from azure.common.credentials import BasicTokenAuthentication
+        from azure.mgmt.storage import StorageManagementClient
+        storageclient = StorageManagementClient(credentials = BasicTokenAuthentication({"access_token": authToken}),
                                                 subscription_id = self.subscriptionId)
 
         # Retrieve keys from storage accounts
         storageKeys = storageclient.storage_accounts.list_keys(resource_group_name = self.resourceGroup,
                                                                account_name = self.accountName)
         if storageKeys is None or len(storageKeys.keys) == 0 :
-           self.log.error("could not retrieve storage keys of the storage account %s" % self.accountName)
-           return None
-        return storageKeys.keys[0].value
+           raise ValueError("could not retrieve storage keys of the storage account %s" % self.accountName)
+        return (storageKeys.keys[0].value, time.time() + STORAGE_KEY_CACHE_SECS)
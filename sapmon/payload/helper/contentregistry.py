@@ -0,0 +1,144 @@
+# Python modules
+import hashlib
+import json
+import logging
+import marshal
+import os
+import re
+import threading
+from typing import Dict, List, Pattern
+
+# Payload modules
+from const import *
+from helper.tools import Singleton
+
+###############################################################################
+
+# Process-wide registry of provider content (check definitions)
+# Each content file is parsed and validated only once and the check definitions are shared by all
+# provider instances of that type, so they must not be modified.
+# Parsed content is also cached on disk (keyed by modification time and hash of the content file).
+class ContentRegistry(metaclass=Singleton):
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.contents = {}
+      self.regexes = {}
+
+   # Get the validated content of a provider type
+   def getContent(self,
+                  tracer: logging.Logger,
+                  providerType: str) -> Dict[str, object]:
+      with self.lock:
+         if providerType not in self.contents:
+            self.contents[providerType] = self._loadContent(tracer, providerType)
+         return self.contents[providerType]
+
+   # Get a compiled regular expression (each pattern is only compiled once)
+   def getRegex(self,
+                pattern: str) -> Pattern:
+      regex = self.regexes.get(pattern, None)
+      if not regex:
+         regex = re.compile(pattern)
+         self.regexes[pattern] = regex
+      return regex
+
+   # Load content from the on-disk cache if the content file has not changed, otherwise parse it
+   def _loadContent(self,
+                    tracer: logging.Logger,
+                    providerType: str) -> Dict[str, object]:
+      filename = os.path.join(PATH_CONTENT, "%s.json" % providerType)
+      cacheFilename = os.path.join(PATH_STATE, "%s.content.cache" % providerType)
+      tracer.debug("filename=%s" % filename)
+      fileStat = os.stat(filename)
+      cache = self._readCache(tracer, cacheFilename)
+      if cache and cache["mtime"] == fileStat.st_mtime_ns and cache["size"] == fileStat.st_size:
+         tracer.debug("using cached content of %s" % filename)
+         self._precompileRegexes(cache["content"])
+         return cache["content"]
+
+      with open(filename, "rb") as file:
+         data = file.read()
+      contentHash = hashlib.sha256(data).hexdigest()
+      if cache and cache["hash"] == contentHash:
+         content = cache["content"]
+      else:
+         tracer.info("parsing content file %s" % filename)
+         content = json.loads(data.decode("utf-8"))
+         self._validateContent(tracer, providerType, content)
+      self._precompileRegexes(content)
+      self._writeCache(tracer,
+                       cacheFilename,
+                       {
+                          "mtime": fileStat.st_mtime_ns,
+                          "size": fileStat.st_size,
+                          "hash": contentHash,
+                          "content": content
+                       })
+      return content
+
+   # Validate the structure of a content file; invalid check definitions are removed
+   def _validateContent(self,
+                        tracer: logging.Logger,
+                        providerType: str,
+                        content: Dict[str, object]) -> None:
+      if not isinstance(content, dict) or not isinstance(content.get("checks", []), list):
+         raise ValueError("content of provider type %s must contain a list of checks" % providerType)
+      validChecks = []
+      for check in content.get("checks", []):
+         try:
+            for key in ("name", "customLog", "frequencySecs", "actions"):
+               if key not in check:
+                  raise ValueError("%s is missing" % key)
+            for action in check["actions"]:
+               if "type" not in action:
+                  raise ValueError("action type is missing")
+               for pattern in self._getRegexParameters(action):
+                  re.compile(pattern)
+         except Exception as e:
+            tracer.error("invalid check %s in content of provider type %s (%s)" % (check.get("name", None) if isinstance(check, dict) else None,
+                                                                                  providerType,
+                                                                                  e))
+            continue
+         validChecks.append(check)
+      content["checks"] = validChecks
+
+   # Compile the regular expressions of all check definitions upfront
+   def _precompileRegexes(self,
+                          content: Dict[str, object]) -> None:
+      for check in content.get("checks", []):
+         for action in check["actions"]:
+            for pattern in self._getRegexParameters(action):
+               self.getRegex(pattern)
+
+   # Get the action parameters that contain regular expressions (by convention, their names end with "Prefixes")
+   @staticmethod
+   def _getRegexParameters(action: Dict[str, object]) -> List[str]:
+      return [value for (name, value) in action.get("parameters", {}).items() if name.endswith("Prefixes") and value]
+
+   # Read the cached content (marshal is much faster to load than JSON)
+   def _readCache(self,
+                  tracer: logging.Logger,
+                  cacheFilename: str) -> Dict[str, object]:
+      try:
+         with open(cacheFilename, "rb") as file:
+            return marshal.load(file)
+      except FileNotFoundError:
+         return None
+      except Exception as e:
+         tracer.warning("could not read content cache %s (%s)" % (cacheFilename,
+                                                                 e))
+         return None
+
+   # Write the cache atomically (a partially written cache file would be ignored anyway)
+   def _writeCache(self,
+                   tracer: logging.Logger,
+                   cacheFilename: str,
+                   cache: Dict[str, object]) -> None:
+      try:
+         tempFilename = "%s.%d.tmp" % (cacheFilename, os.getpid())
+         with open(tempFilename, "wb") as file:
+            marshal.dump(cache, file)
+         os.replace(tempFilename, cacheFilename)
+      except Exception as e:
+         tracer.warning("could not write content cache %s (%s)" % (cacheFilename,
+                                                                  e))
@@ -17,14 +17,16 @@ from helper.tracing import *
 # Internal context handler
 class Context(object):
    azKv = None
+   azLa = None
    sapmonId = None
    vmInstance = None
    vmTage = None
-   analyticsTracer = None
+   analyticsEmitter = None
    tracer = None
 
    globalParams = {}
    instances = []
+   configSecrets = {}
 
    def __init__(self,
                 tracer,
@@ -45,7 +47,7 @@ class Context(object):
          self.tracer.critical("could not extract sapmonId from VM name")
          sys.exit(ERROR_GETTING_SAPMONID)
 
-      self.authToken, self.msiClientId = AzureInstanceMetadataService.getAuthToken(self.tracer)
+      (_, self.msiClientId) = AzureInstanceMetadataService.getAuthToken(self.tracer)
 
       self.tracer.debug("sapmonId=%s" % self.sapmonId)
       self.tracer.debug("msiClientId=%s" % self.msiClientId)
@@ -53,8 +55,8 @@ class Context(object):
       # Add storage queue log handler to tracer
       tracing.addQueueLogHandler(self.tracer, self)
 
-      # Initializing tracer for emitting metrics
-      self.analyticsTracer = tracing.initCustomerAnalyticsTracer(self.tracer, self)
+      # Initializing emitter for customer analytics
+      self.analyticsEmitter = tracing.initCustomerAnalyticsEmitter(self.tracer, self)
 
       # Get KeyVault
       self.azKv = AzureKeyVault(self.tracer,
@@ -64,3 +66,8 @@ class Context(object):
          sys.exit(ERROR_KEYVAULT_NOT_FOUND)
 
       self.tracer.info("successfully initialized context")
+
+   # Current authentication token (read through the credential cache, so it is refreshed before it expires)
+   @property
+   def authToken(self) -> str:
+      return AzureInstanceMetadataService.getAuthToken(self.tracer)[0]
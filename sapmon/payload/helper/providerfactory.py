@@ -1,40 +1,60 @@
+import importlib
 import logging
 import sys
+import threading
+import time
 
 from helper.context import *
-from provider.saphana import *
-from provider.prometheus import *
-from provider.sqlserver import *
+from provider.base import ProviderInstance, ProviderCheck
 
+# Provider types and the module/classes implementing them
+# Provider modules (and their database drivers and client libraries) are only imported once a
+# provider instance of that type is created, so only the types that are actually configured are loaded
 availableProviders = {
-                        "SapHana": (saphanaProviderInstance, saphanaProviderCheck),
-                        "MsSqlServer": (MSSQLProviderInstance, MSSQLProviderCheck),
-                        "PrometheusGeneric": (prometheusProviderInstance, prometheusProviderCheck),
-                        "PrometheusHaCluster": (prometheusProviderInstance, prometheusProviderCheck),
-                        "PrometheusNode": (prometheusProviderInstance, prometheusProviderCheck)
+                        "SapHana": ("provider.saphana", "saphanaProviderInstance", "saphanaProviderCheck"),
+                        "MsSqlServer": ("provider.sqlserver", "MSSQLProviderInstance", "MSSQLProviderCheck"),
+                        "PrometheusGeneric": ("provider.prometheus", "prometheusProviderInstance", "prometheusProviderCheck"),
+                        "PrometheusHaCluster": ("provider.prometheus", "prometheusProviderInstance", "prometheusProviderCheck"),
+                        "PrometheusNode": ("provider.prometheus", "prometheusProviderInstance", "prometheusProviderCheck")
                      }
 
 class ProviderFactory(object):
+   loadedProviders = {}
+   lock = threading.Lock()
+
+   # Import the module of a provider type (only once) and get its instance and check classes
+   @staticmethod
+   def getProviderClasses(providerType: str,
+                          tracer: logging.Logger) -> Tuple[type, type]:
+      if providerType not in availableProviders:
+         raise ValueError("unknown provider type %s" % providerType)
+      with ProviderFactory.lock:
+         if providerType not in ProviderFactory.loadedProviders:
+            (moduleName, instanceClassName, checkClassName) = availableProviders[providerType]
+            startTime = time.perf_counter()
+            module = importlib.import_module(moduleName)
+            tracer.info("loaded provider module %s in %.3fs" % (moduleName,
+                                                                time.perf_counter() - startTime))
+            ProviderFactory.loadedProviders[providerType] = (getattr(module, instanceClassName),
+                                                             getattr(module, checkClassName))
+         return ProviderFactory.loadedProviders[providerType]
+
    @staticmethod
    def makeProviderInstance(providerType: str,
                             tracer: logging.Logger,
                             ctx: Context,
                             instanceProperties: Dict[str, str],
                             **kwargs) -> ProviderInstance:
-      if providerType in availableProviders:
-         providerClass = availableProviders[providerType][0]
-         return providerClass(tracer,
-                              ctx,
-                              instanceProperties,
-                              **kwargs)
-      raise ValueError("unknown provider type %s" % providerType)
+      providerClass = ProviderFactory.getProviderClasses(providerType, tracer)[0]
+      return providerClass(tracer,
+                           ctx,
+                           instanceProperties,
+                           **kwargs)
 
    @staticmethod
    def makeProviderCheck(providerType: str,
                          providerInstance: ProviderInstance,
                          **kwargs) -> ProviderCheck:
-      if providerType in availableProviders:
-         checkClass = availableProviders[providerType][1]
-         return checkClass(providerInstance,
-                           **kwargs)
-      raise ValueError("unknown provider type %s" % providerType)
+      checkClass = ProviderFactory.getProviderClasses(providerType, providerInstance.tracer)[1]
+      return checkClass(providerInstance,
+                        **kwargs)
@@ -0,0 +1,89 @@
+# Python modules
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+from typing import List, Optional
+
+# Payload modules
+from const import *
+
+###############################################################################
+
+# Deadline-based scheduler for provider checks (used in daemon mode)
+# Checks are kept in a min-heap ordered by their next due time (monotonic clock)
+class CheckScheduler:
+   tracer = None
+   queue = []
+   dueTimes = {}
+
+   def __init__(self,
+                tracer: logging.Logger,
+                jitterRatio: float = SCHEDULER_JITTER_RATIO,
+                maxJitterSecs: float = SCHEDULER_MAX_JITTER_SECS):
+      self.tracer = tracer
+      self.jitterRatio = jitterRatio
+      self.maxJitterSecs = maxJitterSecs
+      self.queue = []
+      self.dueTimes = {}
+      self.counter = itertools.count()
+
+   # Get the effective frequency of a check (sub-minute frequencies are honored)
+   @staticmethod
+   def _getFrequencySecs(check) -> float:
+      return max(check.frequencySecs, MIN_CHECK_FREQUENCY_SECS)
+
+   # Random offset for the first run of a check, so checks with equal frequencies don't fire at once
+   def _getJitterSecs(self,
+                      check) -> float:
+      maxJitterSecs = min(self._getFrequencySecs(check) * self.jitterRatio, self.maxJitterSecs)
+      return random.uniform(0, maxJitterSecs)
+
+   def _push(self,
+             dueTime: float,
+             check) -> None:
+      self.dueTimes[check] = dueTime
+      heapq.heappush(self.queue, (dueTime, next(self.counter), check))
+
+   # Replace the set of scheduled checks (e.g. after a config refresh)
+   # Checks that were already scheduled keep their due time, new ones are due based on their last run
+   def update(self,
+              checks: List) -> None:
+      now = time.monotonic()
+      dueTimes = self.dueTimes
+      self.queue = []
+      self.dueTimes = {}
+      for check in checks:
+         if check in dueTimes:
+            dueTime = dueTimes[check]
+         else:
+            dueTime = now + max(check.getSecondsUntilDue(), 0) + self._getJitterSecs(check)
+         self._push(dueTime, check)
+      self.tracer.info("scheduling %d checks" % len(self.queue))
+
+   # Seconds until the next check is due (None if nothing is scheduled)
+   def getSecondsUntilNextDue(self) -> Optional[float]:
+      if not self.queue:
+         return None
+      return max(self.queue[0][0] - time.monotonic(), 0)
+
+   # Remove and return all checks that are currently due, and schedule their next run
+   # The next deadline is derived from the previous deadline (not from the actual run time) to avoid drift;
+   # runs that have been missed entirely are skipped rather than executed in a burst
+   def popDueChecks(self) -> List:
+      now = time.monotonic()
+      dueChecks = []
+      while self.queue and self.queue[0][0] <= now:
+         (dueTime, _, check) = heapq.heappop(self.queue)
+         dueChecks.append(check)
+         frequencySecs = self._getFrequencySecs(check)
+         nextDueTime = dueTime + frequencySecs
+         if nextDueTime <= now:
+            missedRuns = math.floor((now - nextDueTime) / frequencySecs) + 1
+            self.tracer.warning("[%s] check is behind schedule, skipping %d run(s)" % (check.fullName,
+                                                                                     missedRuns))
+            nextDueTime += missedRuns * frequencySecs
+         self._push(nextDueTime, check)
+      return dueChecks
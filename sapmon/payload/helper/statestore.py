@@ -0,0 +1,92 @@
+# Python modules
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict
+
+# Payload modules
+from const import *
+from helper.tools import *
+
+###############################################################################
+
+# Persistent state of a provider instance, stored in a SQLite database (WAL mode)
+# The global state and the state of each check are stored as independent keys;
+# changes are staged in memory and committed in one atomic transaction
+class StateStore:
+   tracer = None
+   filename = None
+   connection = None
+
+   def __init__(self,
+                tracer: logging.Logger,
+                filename: str):
+      self.tracer = tracer
+      self.filename = filename
+      self.connection = None
+      self.lock = threading.Lock()
+      self.stagedValues = {}
+      self.committedValues = {}
+
+   # Open the database (only once it is needed, so instances that are never run don't create one)
+   def _connect(self) -> sqlite3.Connection:
+      if not self.connection:
+         self.connection = sqlite3.connect(self.filename,
+                                           timeout = STATE_STORE_TIMEOUT_SECS,
+                                           check_same_thread = False)
+         self.connection.execute("PRAGMA journal_mode=WAL")
+         self.connection.execute("PRAGMA synchronous=NORMAL")
+         self.connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+         self.connection.commit()
+      return self.connection
+
+   # Check whether the database exists already
+   def exists(self) -> bool:
+      return os.path.isfile(self.filename)
+
+   # Load all keys from the database
+   def load(self) -> Dict[str, object]:
+      values = {}
+      with self.lock:
+         if not self.connection and not self.exists():
+            return values
+         for (key, value) in self._connect().execute("SELECT key, value FROM state"):
+            self.committedValues[key] = value
+            values[key] = json.loads(value, object_hook=JsonDecoder.taggedDatetimeHook)
+      return values
+
+   # Stage a new value for a key (unchanged values are not written again)
+   def put(self,
+           key: str,
+           value: object) -> None:
+      serializedValue = json.dumps(value, separators=(",", ":"), sort_keys=True, cls=StateJsonEncoder)
+      with self.lock:
+         if self.committedValues.get(key, None) == serializedValue:
+            self.stagedValues.pop(key, None)
+         else:
+            self.stagedValues[key] = serializedValue
+
+   # Write all staged values in a single transaction
+   def commit(self) -> int:
+      with self.lock:
+         if not self.stagedValues:
+            return 0
+         stagedValues = self.stagedValues
+         connection = self._connect()
+         with connection:
+            connection.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                                   list(stagedValues.items()))
+         self.committedValues.update(stagedValues)
+         self.stagedValues = {}
+      self.tracer.debug("committed %d state keys to %s" % (len(stagedValues),
+                                                           self.filename))
+      return len(stagedValues)
+
+   # Close the database
+   def close(self) -> None:
+      with self.lock:
+         if self.connection:
+            self.connection.close()
+            self.connection = None
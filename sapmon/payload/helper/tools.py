@@ -1,12 +1,16 @@
 # Python modules
 from datetime import date, datetime, timedelta
 import decimal
+import hashlib
 import http.client as http_client
 import json
 import logging
 import requests
-from typing import Callable, Dict, Optional
+import time
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, List, Optional, Tuple
 from binascii import hexlify
+from urllib3.util.retry import Retry
 
 # Payload modules
 from const import *
@@ -19,7 +23,7 @@ class REST:
    # TODO - improve error handling (include HTTP status together with response)
    def sendRequest(tracer: logging.Logger,
                    endpoint: str,
-                   method: Callable = requests.get,
+                   method: str = "GET",
                    params: Optional[Dict[str, str]] = None,
                    headers: Optional[Dict[str, str]] = None,
                    timeout: int = 5,
@@ -34,11 +38,12 @@ class REST:
          requests_log.setLevel(logging.DEBUG)
          requests_log.propagate = True
       try:
-         response = method(endpoint,
-                           params = params if params else {},
-                           headers = headers if headers else {},
-                           timeout = timeout,
-                           data = data)
+         response = HttpSession().request(method,
+                                          endpoint,
+                                          params = params if params else {},
+                                          headers = headers if headers else {},
+                                          timeout = timeout,
+                                          data = data)
          # Only accept 200 OK
          if response.status_code == requests.codes.ok:
             contentType = response.headers.get("content-type")
@@ -55,22 +60,51 @@ class REST:
 
 ###############################################################################
 
+# Converters for values the json module cannot serialize natively
+def _convertDatetime(o: date) -> str:
+   return datetime.strftime(o, TIME_FORMAT_JSON)
+
+def _convertBinary(o: bytes) -> str:
+   return "0x%s" % hexlify(o).decode("ascii").upper()
+
+JSON_VALUE_CONVERTERS = {
+   decimal.Decimal:  float,
+   datetime:         _convertDatetime,
+   date:             _convertDatetime,
+   bytes:            _convertBinary,
+   bytearray:        _convertBinary,
+}
+
 # Helper class to serialize datetime and Decimal objects into JSON
 class JsonEncoder(json.JSONEncoder):
    # Overwrite encoder for Decimal and datetime objects
+   # (dispatch on the exact type; only subclasses need to be looked up one by one)
    def default(self,
                o: object) -> object:
-      if isinstance(o, decimal.Decimal):
-         return float(o)
-      elif isinstance(o, (datetime, date)):
-         return datetime.strftime(o, TIME_FORMAT_JSON)
-      elif isinstance(o, bytes):
-         s = hexlify(o).decode("ascii")
-         return "0x%s" % s.upper()
-      return super(_JsonEncoder, self).default(o)      
+      converter = JSON_VALUE_CONVERTERS.get(type(o), None)
+      if not converter:
+         converter = next((c for (t, c) in JSON_VALUE_CONVERTERS.items() if isinstance(o, t)), None)
+         if not converter:
+            return super(JsonEncoder, self).default(o)
+      return converter(o)
+
+# Helper class to serialize state into JSON, with datetime values explicitly tagged
+class StateJsonEncoder(JsonEncoder):
+   def default(self,
+               o: object) -> object:
+      if isinstance(o, datetime):
+         return {JSON_TAG_DATETIME: _convertDatetime(o)}
+      return super().default(o)
 
 # Helper class to de-serialize JSON into datetime and Decimal objects
 class JsonDecoder(json.JSONDecoder):
+   # Only convert values that have explicitly been tagged as datetime
+   def taggedDatetimeHook(jsonData: Dict[str, str]) -> object:
+      if len(jsonData) == 1 and JSON_TAG_DATETIME in jsonData:
+         return datetime.strptime(jsonData[JSON_TAG_DATETIME], TIME_FORMAT_JSON)
+      return jsonData
+
+   # Try to convert every string value (only needed for state files written without datetime tags)
    def datetimeHook(jsonData: Dict[str, str]) -> Dict[str, str]:
       for (k, v) in jsonData.items():
          try:
@@ -81,6 +115,135 @@ class JsonDecoder(json.JSONDecoder):
 
 ###############################################################################
 
+# Fast-path JSON encoders for column values (None is handled by the caller)
+def _encodeJsonString(value: str) -> str:
+   return json.encoder.encode_basestring_ascii(value)
+
+def _encodeJsonNumber(value: object) -> str:
+   if isinstance(value, bool):
+      return _encodeJsonBool(value)
+   if isinstance(value, int):
+      return int.__repr__(value)
+   return _encodeJsonFloat(value)
+
+def _encodeJsonFloat(value: object) -> str:
+   value = float(value)
+   if value != value or value in (float("inf"), float("-inf")):
+      return json.dumps(value)
+   return float.__repr__(value)
+
+def _encodeJsonDatetime(value: date) -> str:
+   return '"%s"' % datetime.strftime(value, TIME_FORMAT_JSON)
+
+def _encodeJsonBool(value: bool) -> str:
+   return "true" if value else "false"
+
+def _encodeJsonBinary(value: bytes) -> str:
+   return '"%s"' % _convertBinary(value)
+
+def _encodeJsonGeneric(value: object) -> str:
+   return json.dumps(value, cls=JsonEncoder)
+
+# Column type codes of the DB-API drivers, mapped to the matching encoder
+# (pyodbc reports Python types, hdbcli reports HANA SQL type codes)
+JSON_COLUMN_ENCODERS = {
+   str:              _encodeJsonString,
+   int:              _encodeJsonNumber,
+   float:            _encodeJsonFloat,
+   decimal.Decimal:  _encodeJsonFloat,
+   bool:             _encodeJsonBool,
+   datetime:         _encodeJsonDatetime,
+   date:             _encodeJsonDatetime,
+   bytes:            _encodeJsonBinary,
+   bytearray:        _encodeJsonBinary,
+   1:  _encodeJsonNumber,   # TINYINT
+   2:  _encodeJsonNumber,   # SMALLINT
+   3:  _encodeJsonNumber,   # INTEGER
+   4:  _encodeJsonNumber,   # BIGINT
+   5:  _encodeJsonFloat,    # DECIMAL
+   6:  _encodeJsonFloat,    # REAL
+   7:  _encodeJsonFloat,    # DOUBLE
+   8:  _encodeJsonString,   # CHAR
+   9:  _encodeJsonString,   # VARCHAR
+   10: _encodeJsonString,   # NCHAR
+   11: _encodeJsonString,   # NVARCHAR
+   12: _encodeJsonBinary,   # BINARY
+   13: _encodeJsonBinary,   # VARBINARY
+   14: _encodeJsonDatetime, # DATE
+   16: _encodeJsonDatetime, # TIMESTAMP
+   29: _encodeJsonString,   # STRING
+   30: _encodeJsonString,   # NSTRING
+   61: _encodeJsonDatetime, # LONGDATE
+   62: _encodeJsonDatetime, # SECONDDATE
+   63: _encodeJsonDatetime, # DAYDATE
+}
+
+# Get the JSON encoder of each column of a query result, based on the DB-API type codes in cursor.description
+# (done once per query, so the values of the result rows don't need to be inspected one by one)
+def getColumnEncoders(typeCodes: List[object]) -> List[Callable]:
+   return [JSON_COLUMN_ENCODERS.get(typeCode, _encodeJsonGeneric) for typeCode in typeCodes]
+
+# Encode rows of a query result into compact JSON objects, without building a dictionary per row
+# Keys are written in sorted order; constant fields are only encoded once
+class JsonRowEncoder:
+   def __init__(self,
+                columns: List[Tuple[str, int, Callable]],
+                constantFields: Dict[str, object]):
+      # columns: list of (name, index in row, column encoder)
+      fields = [(name, (idx, encoder)) for (name, idx, encoder) in columns]
+      columnNames = set(name for (name, _) in fields)
+      fields.extend((name, json.dumps(value, sort_keys=True, separators=(",", ":"), cls=JsonEncoder)) for (name, value) in constantFields.items() \
+         if name not in columnNames)
+      self.fields = []
+      for (name, field) in sorted(fields, key=lambda f: f[0]):
+         self.fields.append(("%s:" % json.encoder.encode_basestring_ascii(name), field))
+
+   # Encode a single row into a JSON object
+   def encode(self,
+              row: List[object]) -> str:
+      parts = []
+      for (key, field) in self.fields:
+         if isinstance(field, str):
+            parts.append(key + field)
+            continue
+         (idx, encoder) = field
+         value = row[idx]
+         if value is None:
+            parts.append(key + "null")
+         else:
+            try:
+               parts.append(key + encoder(value))
+            except (TypeError, ValueError, AttributeError):
+               parts.append(key + _encodeJsonGeneric(value))
+      return "{%s}" % ",".join(parts)
+
+# Calculate a stable digest over the typed values of the given columns of a result set
+# (rows are hashed one by one, so the result set is never converted into one large string)
+def calculateResultDigest(resultRows: List[List[object]],
+                          columnIndices: List[int]) -> Optional[str]:
+   if not resultRows:
+      return None
+   digest = hashlib.blake2b(digest_size = RESULT_DIGEST_SIZE)
+   for row in resultRows:
+      digest.update(repr(tuple(row[idx] for idx in columnIndices)).encode("utf-8"))
+      digest.update(b"\n")
+   return digest.hexdigest()
+
+# Calculate the key and the fingerprint of each row of a result set (used to detect changed rows)
+# Rows can be lists (indexed by column position) or dictionaries (indexed by field name)
+def calculateRowFingerprints(resultRows: List[object],
+                             keyIndices: List[object],
+                             columnIndices: List[object]) -> List[Tuple[str, str]]:
+   rowFingerprints = []
+   for row in resultRows:
+      key = json.dumps([row[idx] for idx in keyIndices], separators=(",", ":"), cls=JsonEncoder)
+      fingerprint = hashlib.blake2b(repr(tuple(row[idx] for idx in columnIndices)).encode("utf-8"),
+                                    digest_size = ROW_FINGERPRINT_SIZE).hexdigest()
+      rowFingerprints.append((key, fingerprint))
+   return rowFingerprints
+
+###############################################################################
+
 # Helper class to implement singleton
 class Singleton(type):
    _instances = {}
@@ -88,3 +251,56 @@ class Singleton(type):
       if cls not in cls._instances:
          cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
       return cls._instances[cls]
+
+###############################################################################
+
+# Startup-time benchmark, reporting the import and init cost of each startup phase
+class StartupBenchmark:
+   def __init__(self,
+                startTime: float):
+      self.startTime = startTime
+      self.lastTime = startTime
+      self.phases = []
+
+   # Record the end of a phase (phases are measured back-to-back, starting at startTime)
+   def endPhase(self,
+                phase: str) -> None:
+      now = time.perf_counter()
+      self.phases.append((phase, now - self.lastTime))
+      self.lastTime = now
+
+   # Trace the duration of all phases recorded so far
+   def report(self,
+              tracer: logging.Logger) -> None:
+      tracer.info("startup took %.3fs (%s)" % (self.lastTime - self.startTime,
+                                               ", ".join("%s=%.3fs" % (phase, secs) for (phase, secs) in self.phases)))
+
+###############################################################################
+
+# Shared HTTP session used for all REST calls
+# Keeps connections alive in per-host connection pools (thread-safe) and retries failed connects
+class HttpSession(metaclass=Singleton):
+   session = None
+
+   def __init__(self,
+                poolConnections: int = HTTP_POOL_CONNECTIONS,
+                poolMaxSize: int = HTTP_POOL_MAXSIZE,
+                retries: int = HTTP_RETRIES):
+      # Only idempotent requests are retried on read errors and status codes (no duplicate ingestion)
+      retry = Retry(total = retries,
+                    backoff_factor = HTTP_RETRY_BACKOFF_FACTOR,
+                    status_forcelist = HTTP_RETRY_STATUS_CODES,
+                    raise_on_status = False)
+      adapter = HTTPAdapter(pool_connections = poolConnections,
+                            pool_maxsize = poolMaxSize,
+                            max_retries = retry)
+      self.session = requests.Session()
+      self.session.mount("https://", adapter)
+      self.session.mount("http://", adapter)
+
+   # Send a request using a pooled connection
+   def request(self,
+               method: str,
+               url: str,
+               **kwargs) -> requests.Response:
+      return self.session.request(method, url, **kwargs)
@@ -1,5 +1,4 @@
 # Azure modules
-from azure.mgmt.storage import StorageManagementClient
 from azure_storage_logging.handlers import QueueStorageHandler
 
 # Python modules
@@ -8,7 +7,10 @@ from collections import OrderedDict
 import json
 import logging
 import logging.config
-from typing import Callable, Dict, Optional
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
 
 # Payload modules
 from const import *
@@ -42,12 +44,12 @@ class JsonFormatter(logging.Formatter):
          jsonContent = []
          for f in sorted(self.fieldMapping.keys()):
             jsonContent.append((f, getattr(record, self.fieldMapping[f])))
-         jsonContent.append(("msg", record.msg))
+         jsonContent.append(("msg", record.getMessage()))
 
          # An OrderedDict is used to ensure that the converted data appears in the same order for every record
          return OrderedDict(jsonContent)
       else:
-         return record.msg
+         return record.getMessage()
 
    # Overridden from the parent class to take a log record and output a JSON-formatted string
    def format(self,
@@ -57,6 +59,217 @@ class JsonFormatter(logging.Formatter):
       formattedJson = json.dumps(jsonData, cls=self.customJson)
       return formattedJson
 
+# Deferred, size-capped representation of a (potentially large) payload, such as a result set
+# Pass it as a trace argument: it is only converted into a string if the trace record is actually emitted,
+# and only as many items are converted as fit into maxBytes
+class TracePayload:
+   maxBytes = DEFAULT_TRACE_PAYLOAD_MAX_BYTES
+
+   def __init__(self,
+                payload: object):
+      self.payload = payload
+
+   def __str__(self) -> str:
+      if isinstance(self.payload, (list, tuple)):
+         items = []
+         size = 0
+         for item in self.payload:
+            itemString = str(item)
+            items.append(itemString)
+            size += len(itemString) + 2
+            if size > self.maxBytes:
+               break
+         preview = "[%s]" % ", ".join(items)
+         total = len(self.payload)
+      else:
+         preview = str(self.payload)
+         total = None
+      if len(preview) <= self.maxBytes:
+         return preview
+      if total is not None:
+         return "%s... (%d items)" % (preview[:self.maxBytes], total)
+      return "%s... (%d bytes)" % (preview[:self.maxBytes], len(preview))
+
+# Storage queue log handler that never blocks the logging thread
+# Formatted records are handed over to a background thread, which coalesces them (newline-separated)
+# into as few queue messages as possible; under backpressure, debug records are dropped first
+# (also used without a logger to emit customer analytics, see put())
+class AsyncQueueStorageHandler(QueueStorageHandler):
+   def __init__(self,
+                maxPendingRecords: int = QUEUE_LOG_MAX_PENDING_RECORDS,
+                maxMessageBytes: int = QUEUE_LOG_MAX_MESSAGE_BYTES,
+                flushSecs: float = QUEUE_LOG_FLUSH_SECS,
+                reportDroppedRecords: bool = True,
+                accountKeyProvider: Optional[Callable[[], str]] = None,
+                **kwargs):
+      QueueStorageHandler.__init__(self, **kwargs)
+      self.accountName = kwargs.get("account_name", None)
+      self.accountKey = kwargs.get("account_key", None)
+      self.protocol = kwargs.get("protocol", "https")
+      self.accountKeyProvider = accountKeyProvider
+      self.pendingRecords = queue.Queue(maxsize = maxPendingRecords)
+      self.debugThreshold = int(maxPendingRecords * QUEUE_LOG_DEBUG_DROP_RATIO)
+      self.maxMessageBytes = maxMessageBytes
+      self.flushSecs = flushSecs
+      self.reportDroppedRecords = reportDroppedRecords
+      self.droppedRecords = 0
+      self.inFlightRecords = 0
+      self.countersLock = threading.Condition()
+      self.flushEvent = threading.Event()
+      self.stopEvent = threading.Event()
+      self.shipperThread = threading.Thread(target = self._shipRecords,
+                                            name = "QueueStorageLogShipper",
+                                            daemon = True)
+      self.shipperThread.start()
+
+   # Hand over one line to the background thread
+   # Returns False if it had to be dropped, because too many lines are pending
+   def put(self,
+           line: str,
+           isDroppable: bool = False) -> bool:
+      if isDroppable and self.pendingRecords.qsize() >= self.debugThreshold:
+         self._countDropped(1)
+         return False
+      with self.countersLock:
+         try:
+            self.pendingRecords.put_nowait(line)
+         except queue.Full:
+            self.droppedRecords += 1
+            return False
+         self.inFlightRecords += 1
+      return True
+
+   # Count records that have been dropped (and are no longer in flight, if they have been handed over)
+   def _countDropped(self,
+                     count: int,
+                     inFlight: int = 0) -> None:
+      with self.countersLock:
+         self.droppedRecords += count
+         self._countDone(inFlight)
+
+   # Count records that have been shipped or dropped by the background thread
+   def _countDone(self,
+                  count: int) -> None:
+      with self.countersLock:
+         self.inFlightRecords -= count
+         if self.inFlightRecords <= 0:
+            self.countersLock.notify_all()
+
+   # Hand over a formatted record to the background thread
+   def emit(self,
+            record: logging.LogRecord) -> None:
+      try:
+         self.put(self.format(record),
+                  isDroppable = record.levelno <= logging.DEBUG)
+      except Exception:
+         self.handleError(record)
+
+   # Collect formatted records into one message, until it is full or flushSecs have passed
+   # Returns the lines of the message, the line that did not fit anymore and the number of handed-over records
+   # in the message (a report of dropped records is not one of them)
+   def _collectMessage(self,
+                       carry: Optional[str]) -> Tuple[List[str], Optional[str], int]:
+      lines = []
+      size = 0
+      reportLines = 0
+      with self.countersLock:
+         droppedRecords = self.droppedRecords
+         self.droppedRecords = 0
+      if self.reportDroppedRecords and droppedRecords > 0:
+         lines.append(json.dumps({"msg": "dropped %d log records due to backpressure or size" % droppedRecords}))
+         size += len(lines[-1]) + 1
+         reportLines = 1
+      if carry is not None:
+         lines.append(carry)
+         size += len(carry) + 1
+      deadline = time.monotonic() + self.flushSecs
+      while True:
+         timeout = deadline - time.monotonic()
+         if self.flushEvent.is_set() or self.stopEvent.is_set():
+            timeout = 0
+         try:
+            if timeout > 0:
+               line = self.pendingRecords.get(timeout = timeout)
+            else:
+               line = self.pendingRecords.get_nowait()
+         except queue.Empty:
+            return (lines, None, len(lines) - reportLines)
+         # Wake-up call from flush(), the message is sent right away
+         if line is None:
+            continue
+         # A record that does not fit into one message is dropped (cutting it would break its JSON)
+         if len(line) >= self.maxMessageBytes:
+            self._countDropped(1, inFlight = 1)
+            continue
+         if size + len(line) + 1 > self.maxMessageBytes:
+            return (lines, line, len(lines) - reportLines)
+         lines.append(line)
+         size += len(line) + 1
+
+   # Switch to the current account key, if it has been refreshed since the last message
+   def _refreshAccountKey(self) -> None:
+      if not self.accountKeyProvider:
+         return
+      accountKey = self.accountKeyProvider()
+      if accountKey and accountKey != self.accountKey:
+         self.service = type(self.service)(account_name = self.accountName,
+                                           account_key = accountKey,
+                                           protocol = self.protocol)
+         self.accountKey = accountKey
+
+   # Put one message into the storage queue
+   def _putMessage(self,
+                   text: str) -> None:
+      self._refreshAccountKey()
+      if not self.queue_created:
+         self.service.create_queue(self.queue)
+         self.queue_created = True
+      self.service.put_message(self.queue,
+                               self._encode_text(text),
+                               self.visibility_timeout,
+                               self.message_ttl)
+
+   # Background loop shipping pending records to the storage queue
+   def _shipRecords(self) -> None:
+      carry = None
+      while not self.stopEvent.is_set() or not self.pendingRecords.empty() or carry is not None:
+         (lines, carry, shippedRecords) = self._collectMessage(carry)
+         if not lines:
+            self.flushEvent.clear()
+            continue
+         try:
+            self._putMessage("\n".join(lines))
+            self._countDone(shippedRecords)
+         except Exception:
+            self._countDropped(shippedRecords, inFlight = shippedRecords)
+
+   # Wait until all records handed over so far have been shipped (or dropped), including those that
+   # the background thread is currently collecting or sending (used when the payload exits)
+   def flush(self) -> None:
+      deadline = time.monotonic() + QUEUE_LOG_FLUSH_TIMEOUT_SECS
+      self.flushEvent.set()
+      self._wakeUp()
+      with self.countersLock:
+         while self.inFlightRecords > 0:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+               break
+            self.countersLock.wait(timeout)
+
+   # Wake up the background thread if it is waiting for records
+   def _wakeUp(self) -> None:
+      try:
+         self.pendingRecords.put_nowait(None)
+      except queue.Full:
+         pass
+
+   def close(self) -> None:
+      self.flush()
+      self.stopEvent.set()
+      self._wakeUp()
+      self.shipperThread.join(QUEUE_LOG_FLUSH_TIMEOUT_SECS)
+      QueueStorageHandler.close(self)
+
 # Helper class to enable all kinds of tracing
 class tracing:
    config = {
@@ -135,15 +348,15 @@ class tracing:
       try:
          storageQueue = AzureStorageQueue(tracer,
                                           ctx.sapmonId,
-                                          ctx.authToken,
                                           ctx.vmInstance["subscriptionId"],
                                           ctx.vmInstance["resourceGroupName"],
                                           queueName = STORAGE_QUEUE_NAMING_CONVENTION % ctx.sapmonId)
          storageKey = storageQueue.getAccessKey()
-         queueStorageLogHandler = QueueStorageHandler(account_name=storageQueue.accountName,
-                                                      account_key = storageKey,
-                                                      protocol = "https",
-                                                      queue = storageQueue.name)
+         queueStorageLogHandler = AsyncQueueStorageHandler(account_name=storageQueue.accountName,
+                                                           account_key = storageKey,
+                                                           protocol = "https",
+                                                           queue = storageQueue.name,
+                                                           accountKeyProvider = storageQueue.getAccessKey)
          queueStorageLogHandler.level = DEFAULT_QUEUE_TRACE_LEVEL
          jsonFormatter = JsonFormatter(tracing.config["formatters"]["json"]["fieldMapping"])
          queueStorageLogHandler.setFormatter(jsonFormatter)
@@ -157,44 +370,46 @@ class tracing:
       tracer.addHandler(queueStorageLogHandler)
       return
 
-   # Initialize customer metrics tracer object
+   # Initialize the emitter for customer analytics
    @staticmethod
-   def initCustomerAnalyticsTracer(tracer: logging.Logger,
-                                   ctx) -> logging.Logger:
-       tracer.info("creating customer metrics tracer object")
+   def initCustomerAnalyticsEmitter(tracer: logging.Logger,
+                                    ctx) -> AsyncQueueStorageHandler:
+       tracer.info("creating customer analytics emitter")
        try:
            storageQueue = AzureStorageQueue(tracer,
                                             ctx.sapmonId,
-                                            ctx.authToken,
                                             ctx.vmInstance["subscriptionId"],
                                             ctx.vmInstance["resourceGroupName"],
                                             CUSTOMER_METRICS_QUEUE_NAMING_CONVENTION % ctx.sapmonId)
            storageKey = storageQueue.getAccessKey()
-           customerMetricsLogHandler = QueueStorageHandler(account_name = storageQueue.accountName,
-                                                           account_key = storageKey,
-                                                           protocol = "https",
-                                                           queue = storageQueue.name)
+           customerAnalyticsEmitter = AsyncQueueStorageHandler(account_name = storageQueue.accountName,
+                                                               account_key = storageKey,
+                                                               protocol = "https",
+                                                               queue = storageQueue.name,
+                                                               accountKeyProvider = storageQueue.getAccessKey,
+                                                               maxPendingRecords = ANALYTICS_MAX_PENDING_RECORDS,
+                                                               reportDroppedRecords = False)
        except Exception as e:
-           tracer.error("could not add handler for the storage queue logging (%s) " % e)
-           return
-
-       logger = logging.getLogger("customerMetricsLogger")
-       logger.addHandler(customerMetricsLogHandler)
-       return logger
+           tracer.error("could not create emitter for customer analytics (%s) " % e)
+           return None
+       return customerAnalyticsEmitter
 
    # Ingest metrics into customer analytics
+   # Each JSON-encoded record is wrapped into one line; lines are shipped in batches in the background
    @staticmethod
    def ingestCustomerAnalytics(tracer: logging.Logger,
                                ctx,
                                customLog: str,
-                               resultJson: str) -> None:
+                               resultRecords: List[str]) -> None:
       tracer.info("sending customer analytics")
-      results = json.loads(resultJson)
-      for result in results:
-         metrics = {
-            "Type": customLog,
-            "Data": result,
-         }
-         j = json.dumps(metrics)
-         ctx.analyticsTracer.debug(j)
+      if not ctx.analyticsEmitter:
+         return
+      prefix = '{"Type":%s,"Data":' % json.dumps(customLog)
+      droppedRecords = 0
+      for record in resultRecords:
+         if not ctx.analyticsEmitter.put(prefix + record + "}"):
+            droppedRecords += 1
+      if droppedRecords > 0:
+         tracer.warning("dropped %d customer analytics records of %s due to backpressure" % (droppedRecords,
+                                                                                            customLog))
       return
@@ -3,12 +3,15 @@ from abc import ABC, abstractmethod
 from datetime import date, datetime, timedelta
 import json
 import logging
+import threading
 from retry.api import retry_call
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 # Payload modules
 from const import *
 from helper.context import *
+from helper.contentregistry import ContentRegistry
+from helper.statestore import StateStore
 from helper.tools import *
 
 ###############################################################################
@@ -25,13 +28,17 @@ class ProviderInstance(ABC):
    checks = []
    state = {}
    retrySettings = {}
+   maxConcurrentChecks = 1
+   stateLock = None
+   stateStore = None
    
    def __init__(self,
                 tracer: logging.Logger,
                 ctx: Context,
                 providerInstance: Dict[str, str],
                 retrySettings: Dict[str, int],
-                skipContent: bool = False):
+                skipContent: bool = False,
+                maxConcurrentChecks: int = 1):
       # This constructor gets called after the child class
       self.tracer = tracer
       self.ctx = ctx
@@ -42,23 +49,24 @@ class ProviderInstance(ABC):
       self.fullName = "%s/%s" % (self.providerType, self.name)
       self.state = {}
       self.retrySettings = retrySettings
+      self.maxConcurrentChecks = maxConcurrentChecks
+      self.stateLock = threading.RLock()
+      self.stateStore = StateStore(self.tracer,
+                                   os.path.join(PATH_STATE, "%s.state.db" % self.name))
       if not self.parseProperties():
          raise ValueError("failed to parse properties of the provider instance")
       if not skipContent and not self.initContent():
          raise Exception("failed to initialize content")
       self.readState()
 
-   # Read provider content file
+   # Read provider content (shared by all instances of the same provider type)
    def initContent(self) -> bool:
       from helper.providerfactory import ProviderFactory
 
       self.tracer.info("[%s] initializing content for provider instance" % self.fullName)
+      filename = os.path.join(PATH_CONTENT, "%s.json" % self.providerType)
       try:
-         filename = os.path.join(PATH_CONTENT, "%s.json" % self.providerType)
-         self.tracer.debug("filename=%s" % filename)
-         with open(filename, "r") as file:
-            data = file.read()
-         jsonData = json.loads(data, object_hook=JsonDecoder.datetimeHook)
+         jsonData = ContentRegistry().getContent(self.tracer, self.providerType)
       except FileNotFoundError as e:
          self.tracer.warning("[%s] content file %s does not exist" % (self.fullName,
                                                                       filename))
@@ -88,77 +96,161 @@ class ProviderInstance(ABC):
                                                                                               e))
       return True
 
-   # Read most recent, provider-specific state from state file
+   # Read most recent, provider-specific state from the state store
+   # (the state file of earlier versions is migrated into the state store once)
    def readState(self) -> bool:
-      self.tracer.info("[%s] reading state file for provider instance" % self.fullName)
-      jsonData = {}
-
-      # Parse JSON for all check states of this provider
+      self.tracer.info("[%s] reading state for provider instance" % self.fullName)
       try:
-         filename = os.path.join(PATH_STATE, "%s.state" % self.name)
-         self.tracer.debug("[%s] filename=%s" % (self.fullName,
-                                                 filename))
-         with open(filename, "r") as file:
-            data = file.read()
-         jsonData = json.loads(data, object_hook=JsonDecoder.datetimeHook)
-      except FileNotFoundError as e:
-         self.tracer.warning("[%s] state file %s does not exist" % (self.fullName,
-                                                                    filename))
-         return False
+         storedStates = self.stateStore.load()
+         isMigrated = False
+         if not storedStates:
+            storedStates = self._readLegacyStateFile()
+            isMigrated = bool(storedStates)
       except Exception as e:
-         self.tracer.error("[%s] could not read state file %s (%s)" % (self.fullName,
-                                                                       filename,
+         self.tracer.error("[%s] could not read state from %s (%s)" % (self.fullName,
+                                                                       self.stateStore.filename,
                                                                        e))
          return False
+      if not storedStates:
+         self.tracer.warning("[%s] no state stored in %s" % (self.fullName,
+                                                             self.stateStore.filename))
+         return False
 
       # Update global state for this provider
-      self.state = jsonData.get("global", {})
-      self.tracer.debug("[%s] global state=%s" % (self.fullName, str(self.state)))
+      self.state = storedStates.get(STATE_KEY_GLOBAL, {})
+      self.tracer.debug("[%s] global state=%s", self.fullName, TracePayload(self.state))
 
       # Update state for each individual check of this provider
-      checkStates = jsonData.get("checks", {})
       saveIsEnabled = None
       for check in self.checks:
          if "isEnabled" in check.state:
             saveIsEnabled = check.state["isEnabled"]
-         check.state = checkStates.get(check.name, {})
+         check.state = storedStates.get(STATE_KEY_CHECK % check.name, {})
          if saveIsEnabled is not None:
             check.state["isEnabled"] = saveIsEnabled
-         self.tracer.debug("[%s] check state=%s" % (check.fullName, str(check.state)))
-      self.tracer.info("[%s] successfully read state file for provider instance" % self.fullName)
+         self.tracer.debug("[%s] check state=%s", check.fullName, TracePayload(check.state))
+      if isMigrated:
+         self.tracer.info("[%s] migrating state file into %s" % (self.fullName,
+                                                                 self.stateStore.filename))
+         self.writeState()
+      self.tracer.info("[%s] successfully read state for provider instance" % self.fullName)
       return True
 
-   # Write current state for this provider and its checks into state file
-   def writeState(self) -> bool:
-      self.tracer.info("[%s] writing state file for provider instance" % self.fullName)
+   # Read the state file written by earlier versions (one JSON document for the whole provider instance)
+   def _readLegacyStateFile(self) -> Dict[str, object]:
+      filename = os.path.join(PATH_STATE, "%s.state" % self.name)
+      self.tracer.debug("[%s] filename=%s" % (self.fullName,
+                                              filename))
+      try:
+         with open(filename, "r") as file:
+            data = file.read()
+      except FileNotFoundError as e:
+         return {}
+      jsonData = json.loads(data, object_hook=JsonDecoder.taggedDatetimeHook)
+      # Only state files of format version 2 tag their datetime values
+      if jsonData.get("version", None) != STATE_FORMAT_VERSION:
+         jsonData = json.loads(data, object_hook=JsonDecoder.datetimeHook)
+      storedStates = {STATE_KEY_GLOBAL: jsonData.get("global", {})}
+      for (checkName, checkState) in jsonData.get("checks", {}).items():
+         storedStates[STATE_KEY_CHECK % checkName] = checkState
+      return storedStates
 
-      # Initialize JSON object with global state
-      jsonData = {
-         "global": self.state
-      }
+   # Stage the current state of this provider and the given checks (default: all checks) in the state store
+   # Only keys whose state has changed are written on the next commit
+   def stageState(self,
+                  checks: Optional[List] = None) -> bool:
+      # Checks of this provider instance may run concurrently, so states are snapshotted under a lock
+      try:
+         with self.stateLock:
+            self.stateStore.put(STATE_KEY_GLOBAL, dict(self.state))
+            for check in (checks if checks is not None else self.checks):
+               self.stateStore.put(STATE_KEY_CHECK % check.name, dict(check.state))
+      except Exception as e:
+         self.tracer.error("[%s] could not stage state (%s)" % (self.fullName,
+                                                               e))
+         return False
+      return True
 
-      # Build dictionary with states for all checks of this provider and insert it into JSON object
-      checkStates = {}
-      for check in self.checks:
-         checkStates[check.name] = check.state
-      jsonData["checks"] = checkStates
+   # Set or remove one key of the state of this provider instance
+   # (checks of this provider instance may run concurrently, so shared state is only changed under the state lock)
+   def setState(self,
+                key: str,
+                value: object) -> None:
+      with self.stateLock:
+         self.state[key] = value
+
+   def popState(self,
+                key: str) -> object:
+      with self.stateLock:
+         return self.state.pop(key, None)
 
-      # Write JSON object into state file
+   # Atomically write all staged states into the state store
+   def commitState(self) -> bool:
       try:
-         filename = os.path.join(PATH_STATE, "%s.state" % self.name)
-         self.tracer.debug("[%s] filename=%s" % (self.fullName,
-                                                 filename))
-         with open(filename, "w") as file:
-            json.dump(jsonData, file, indent=3, cls=JsonEncoder)
+         numKeys = self.stateStore.commit()
       except Exception as e:
-         self.tracer.error("[%s] could not write state file %s (%s)" % (self.fullName,
-                                                                        filename,
-                                                                        e))
+         self.tracer.error("[%s] could not commit state to %s (%s)" % (self.fullName,
+                                                                       self.stateStore.filename,
+                                                                       e))
          return False
-
-      self.tracer.info("[%s] successfully wrote state file for provider instance" % self.fullName)
+      if numKeys:
+         self.tracer.info("[%s] successfully committed state of %d keys" % (self.fullName,
+                                                                           numKeys))
       return True
 
+   # Write current state for this provider and all its checks into the state store
+   def writeState(self) -> bool:
+      return self.stageState() and self.commitState()
+
+   # Get the maximum number of checks of this provider instance that may run in parallel
+   # (can be overridden per provider type via the global config parameter maxConcurrentChecks)
+   def getMaxConcurrentChecks(self) -> int:
+      maxConcurrentChecks = self.ctx.globalParams.get("maxConcurrentChecks", {})
+      try:
+         if not isinstance(maxConcurrentChecks, dict):
+            raise TypeError("maxConcurrentChecks must map provider types to numbers of checks")
+         maxConcurrentChecks = maxConcurrentChecks.get(self.providerType, self.maxConcurrentChecks)
+         return max(int(maxConcurrentChecks), 1)
+      except (TypeError, ValueError):
+         self.tracer.error("[%s] invalid value maxConcurrentChecks=%s, using %d" % (self.fullName,
+                                                                                   maxConcurrentChecks,
+                                                                                   self.maxConcurrentChecks))
+         return self.maxConcurrentChecks
+
+   # Group checks into stages that run one after another, so checks only start after the checks they depend on
+   # (dependencies on checks that are not part of the given checks are ignored)
+   def getCheckStages(self,
+                      checks: List) -> List[List]:
+      checkNames = set(check.name for check in checks)
+      finishedNames = set()
+      pendingChecks = list(checks)
+      stages = []
+      while pendingChecks:
+         stage = [check for check in pendingChecks \
+            if all(name in finishedNames or name not in checkNames for name in check.dependsOn)]
+         if not stage:
+            self.tracer.error("[%s] circular dependencies between checks %s" % (self.fullName,
+                                                                              ", ".join(c.name for c in pendingChecks)))
+            stage = pendingChecks
+         stages.append(stage)
+         finishedNames.update(check.name for check in stage)
+         pendingChecks = [check for check in pendingChecks if check not in stage]
+      return stages
+
+   # Get the checks a check depends on that have never run (and are not part of the given checks)
+   def getUnmetDependencies(self,
+                            check,
+                            checks: List) -> List[str]:
+      checkNames = set(c.name for c in checks)
+      lastRuns = {c.name: c.state.get("lastRunLocal", None) for c in self.checks}
+      return [name for name in check.dependsOn if name not in checkNames and not lastRuns.get(name, None)]
+
+   # Release resources held by this provider instance (e.g. pooled connections)
+   # Providers that hold additional resources extend this method
+   def close(self) -> None:
+      self.commitState()
+      self.stateStore.close()
+
    # Provider-specific validation logic (e.g. establish HANA connection)
    @abstractmethod
    def validate(self) -> bool:
@@ -184,6 +276,14 @@ class ProviderCheck(ABC):
    fullName = None
    tracer = None
    colTimeGenerated = None
+   ingestOnChange = False
+   heartbeatSecs = None
+   deltaKeyColumns = None
+   fullSnapshotSecs = None
+   lastRecords = None
+   dependsOn = []
+   # Fields that change with every run (besides colTimeGenerated) and are ignored when detecting changed rows
+   volatileFields = ()
 
    def __init__(self,
                 providerInstance: ProviderInstance,
@@ -193,13 +293,28 @@ class ProviderCheck(ABC):
                 frequencySecs: int,
                 actions: List[str],
                 includeInCustomerAnalytics: bool = False,
-                enabled: bool = True):
+                enabled: bool = True,
+                ingestOnChange: bool = False,
+                heartbeatSecs: Optional[int] = None,
+                deltaKeyColumns: Optional[List[str]] = None,
+                fullSnapshotSecs: int = DEFAULT_DELTA_FULL_SNAPSHOT_SECS,
+                dependsOn: Optional[List[str]] = None):
       self.providerInstance = providerInstance
       self.name = name
       self.description = description
       self.customLog = customLog
       self.frequencySecs = frequencySecs
       self.includeInCustomerAnalytics = includeInCustomerAnalytics
+      # Only ingest results that have changed since the last ingestion;
+      # with heartbeatSecs, a single heartbeat record is ingested at that interval while the result is unchanged
+      self.ingestOnChange = ingestOnChange or bool(heartbeatSecs)
+      self.heartbeatSecs = heartbeatSecs
+      # Only ingest inserted, changed and deleted rows (identified by deltaKeyColumns);
+      # the full result is still ingested every fullSnapshotSecs for reconciliation
+      self.deltaKeyColumns = deltaKeyColumns
+      self.fullSnapshotSecs = fullSnapshotSecs
+      # Names of checks (of the same provider instance) that need to run before this check
+      self.dependsOn = dependsOn if dependsOn else []
       self.actions = actions
       self.state = {
          "isEnabled": enabled,
@@ -207,10 +322,12 @@ class ProviderCheck(ABC):
       }
       self.fullName = "%s.%s" % (self.providerInstance.fullName, self.name)
       self.tracer = providerInstance.tracer
+      # State that may only be advanced once the records of the last run have been ingested
+      self.pendingIngestState = {}
 
    # Return if this check is enabled or not
    def isEnabled(self) -> bool:
-      self.tracer.debug("[%s] verifying if check is enabled" % self.fullName)
+      self.tracer.debug("[%s] verifying if check is enabled", self.fullName)
       if not self.state["isEnabled"]:
          self.tracer.info("[%s] check is currently not enabled, skipping" % self.fullName)
          return False
@@ -220,29 +337,37 @@ class ProviderCheck(ABC):
    def isDue(self) -> bool:
       # lastRunLocal = last execution time on collector VM
       # lastRunServer (used in provider) = last execution time on (HANA) server
-      self.tracer.debug("[%s] verifying if check is due to be run" % self.fullName)
+      self.tracer.debug("[%s] verifying if check is due to be run", self.fullName)
       lastRunLocal = self.state.get("lastRunLocal", None)
-      self.tracer.debug("[%s] lastRunLocal=%s; frequencySecs=%d; currentLocal=%s" % (self.fullName,
-                                                                                     lastRunLocal,
-                                                                                     self.frequencySecs,
-                                                                                     datetime.utcnow()))
+      currentLocal = datetime.utcnow()
+      self.tracer.debug("[%s] lastRunLocal=%s; frequencySecs=%d; currentLocal=%s",
+                        self.fullName,
+                        lastRunLocal,
+                        self.frequencySecs,
+                        currentLocal)
       if lastRunLocal and \
-         lastRunLocal + timedelta(seconds = self.frequencySecs) > datetime.utcnow():
+         lastRunLocal + timedelta(seconds = self.frequencySecs) > currentLocal:
          self.tracer.info("[%s] check is not due yet, skipping" % self.fullName)
          return False
       return True
 
+   # Determine how many seconds are left until this check is due to be executed
+   def getSecondsUntilDue(self) -> float:
+      lastRunLocal = self.state.get("lastRunLocal", None)
+      if not isinstance(lastRunLocal, datetime):
+         return 0
+      nextRunLocal = lastRunLocal + timedelta(seconds = self.frequencySecs)
+      return (nextRunLocal - datetime.utcnow()).total_seconds()
+
    # Method that gets called when this check is executed
-   # Returns a JSON-formatted string that can be ingested into Log Analytics
-   def run(self) -> str:
+   # Returns a list of JSON-encoded records that can be ingested into Log Analytics
+   def run(self) -> List[str]:
       self.tracer.info("[%s] executing all actions of check" % self.fullName)
-      self.tracer.debug("[%s] actions=%s" % (self.fullName,
-                                             self.actions))
+      self.tracer.debug("[%s] actions=%s", self.fullName, TracePayload(self.actions))
       for action in self.actions:
          methodName = METHODNAME_ACTION % action["type"]
          parameters = action.get("parameters", {})
-         self.tracer.debug("[%s] calling action %s" % (self.fullName,
-                                                       methodName))
+         self.tracer.debug("[%s] calling action %s", self.fullName, methodName)
          method = getattr(self, methodName)
          tries = action.get("retries", self.providerInstance.retrySettings["retries"])
          delay = action.get("delayInSeconds", self.providerInstance.retrySettings["delayInSeconds"])
@@ -255,12 +380,170 @@ class ProviderCheck(ABC):
                                                                                                             methodName,
                                                                                                             e))
             break
-      return self.generateJsonString()
+      return self.generateJsonRecords()
+
+   # Select the records of the last run that need to be ingested into Log Analytics
+   # (run() returns the full result, which is still used for Customer Analytics)
+   def selectRecordsToIngest(self,
+                             jsonRecords: List[str]) -> List[str]:
+      if self.deltaKeyColumns:
+         return self.applyDeltaPolicy(jsonRecords)
+      return self.applyIngestPolicy(jsonRecords)
+
+   # Get the hash of the last result (used to detect unchanged results)
+   # Providers that support change detection override this method
+   def getResultHash(self) -> Optional[str]:
+      return None
+
+   # Skip ingesting results that have not changed since they were last ingested (if enabled for this check)
+   def applyIngestPolicy(self,
+                         jsonRecords: List[str]) -> List[str]:
+      if not self.ingestOnChange:
+         return jsonRecords
+      resultHash = self.getResultHash()
+      currentLocal = datetime.utcnow()
+      if resultHash is None or resultHash != self.state.get("lastIngestedHash", None):
+         self.pendingIngestState["lastIngestedHash"] = resultHash
+         self.pendingIngestState["lastHeartbeatLocal"] = currentLocal
+         return jsonRecords
+
+      # Result has not changed; only send a heartbeat record if one is due
+      lastHeartbeatLocal = self.state.get("lastHeartbeatLocal", None)
+      if self.heartbeatSecs and \
+         (not isinstance(lastHeartbeatLocal, datetime) or \
+          lastHeartbeatLocal + timedelta(seconds = self.heartbeatSecs) <= currentLocal):
+         self.tracer.info("[%s] result has not changed, only ingesting heartbeat" % self.fullName)
+         self.pendingIngestState["lastHeartbeatLocal"] = currentLocal
+         return [self.generateHeartbeatRecord(resultHash,
+                                              len(jsonRecords))]
+      self.tracer.info("[%s] result has not changed, skipping ingestion" % self.fullName)
+      return []
+
+   # Get the callback to pass along with the records of the last run when ingesting them
+   # The state that depends on their ingestion is only advanced (and staged) once all of them have been ingested;
+   # otherwise, the next run ingests its result as if this run had not happened
+   def getIngestCallback(self) -> Callable[[bool], None]:
+      (pendingState, self.pendingIngestState) = (self.pendingIngestState, {})
+      def onIngested(success: bool) -> None:
+         if not pendingState:
+            return
+         if not success:
+            self.tracer.warning("[%s] result could not be ingested, ingestion state is not advanced" % self.fullName)
+            return
+         with self.providerInstance.stateLock:
+            self.state.update(pendingState)
+         self.providerInstance.stageState([self])
+      return onIngested
+
+   # Generate a record that indicates an unchanged result (instead of ingesting the result again)
+   def generateHeartbeatRecord(self,
+                               resultHash: str,
+                               recordCount: int) -> str:
+      return self._generateStatusRecord({
+         "HEARTBEAT": True,
+         "RESULT_HASH": resultHash,
+         "RECORD_COUNT": recordCount
+      })
 
-   # Method to generate a JSON object that can be ingested into Log Analytics
+   # Generate a record that is not part of the result itself (e.g. heartbeats or deleted rows)
+   def _generateStatusRecord(self,
+                             fields: Dict[str, object]) -> str:
+      record = {
+         "SAPMON_VERSION": PAYLOAD_VERSION,
+         "PROVIDER_INSTANCE": self.providerInstance.name,
+         "METADATA": self.providerInstance.metadata
+      }
+      record.update(fields)
+      if self.colTimeGenerated:
+         record[self.colTimeGenerated] = datetime.utcnow()
+      return json.dumps(record, sort_keys=True, separators=(",", ":"), cls=JsonEncoder)
+
+   # Get the key and fingerprint of each record of the last result (in the same order as the records)
+   # Providers that encode their results directly override this method
+   def generateRowFingerprints(self) -> Optional[List[Tuple[str, str]]]:
+      if self.lastRecords is None:
+         return None
+      if not self.lastRecords:
+         return []
+      ignoredFields = set(self.volatileFields) | set([self.colTimeGenerated])
+      columns = sorted(c for c in self.lastRecords[0].keys() if c not in ignoredFields)
+      return calculateRowFingerprints(self.lastRecords, self.deltaKeyColumns, columns)
+
+   # Only ingest the records that have been inserted, changed or deleted since the last run
+   # (each record is tagged with its CHANGE_TYPE; a full SNAPSHOT is ingested periodically)
+   def applyDeltaPolicy(self,
+                        jsonRecords: List[str]) -> List[str]:
+      try:
+         rowFingerprints = self.generateRowFingerprints()
+      except Exception as e:
+         self.tracer.error("[%s] could not calculate row fingerprints for deltaKeyColumns=%s (%s)" % (self.fullName,
+                                                                                                      self.deltaKeyColumns,
+                                                                                                      e))
+         rowFingerprints = None
+      if rowFingerprints is None or len(rowFingerprints) != len(jsonRecords):
+         self.tracer.warning("[%s] row-level changes not available, ingesting full result" % self.fullName)
+         return jsonRecords
+
+      # The index (and snapshot time) is only advanced once these records have been ingested
+      previousIndex = self.state.get("deltaIndex", None)
+      currentIndex = dict(rowFingerprints)
+      self.pendingIngestState["deltaIndex"] = currentIndex
+      currentLocal = datetime.utcnow()
+      lastSnapshotLocal = self.state.get("lastSnapshotLocal", None)
+      if previousIndex is None or \
+         not isinstance(lastSnapshotLocal, datetime) or \
+         lastSnapshotLocal + timedelta(seconds = self.fullSnapshotSecs) <= currentLocal:
+         self.tracer.info("[%s] ingesting full snapshot of %d records" % (self.fullName,
+                                                                         len(jsonRecords)))
+         self.pendingIngestState["lastSnapshotLocal"] = currentLocal
+         return [self._tagRecord(r, "SNAPSHOT") for r in jsonRecords]
+
+      deltaRecords = []
+      for (jsonRecord, (key, fingerprint)) in zip(jsonRecords, rowFingerprints):
+         previousFingerprint = previousIndex.get(key, None)
+         if previousFingerprint is None:
+            deltaRecords.append(self._tagRecord(jsonRecord, "INSERT"))
+         elif previousFingerprint != fingerprint:
+            deltaRecords.append(self._tagRecord(jsonRecord, "UPDATE"))
+      for key in previousIndex.keys():
+         if key not in currentIndex:
+            deletedRecord = dict(zip(self.deltaKeyColumns, json.loads(key)))
+            deletedRecord["CHANGE_TYPE"] = "DELETE"
+            deltaRecords.append(self._generateStatusRecord(deletedRecord))
+      self.tracer.info("[%s] ingesting %d changed of %d records" % (self.fullName,
+                                                                  len(deltaRecords),
+                                                                  len(jsonRecords)))
+      return deltaRecords
+
+   # Add the CHANGE_TYPE field to a JSON-encoded record
+   @staticmethod
+   def _tagRecord(jsonRecord: str,
+                  changeType: str) -> str:
+      return '{"CHANGE_TYPE":"%s",%s' % (changeType, jsonRecord[1:])
+
+   # Method to generate the records (one dictionary per row) that will be ingested into Log Analytics
+   # (providers that encode their results directly also override generateJsonRecords)
    @abstractmethod
-   def generateJsonString(self) -> str:
-      return
+   def generateRecords(self) -> List[Dict]:
+      pass
+
+   # Encode each record into a compact JSON string
+   # These strings will be ingested into Log Analytics and Customer Analytics
+   def generateJsonRecords(self) -> List[str]:
+      records = self.generateRecords()
+      self.lastRecords = records if self.deltaKeyColumns else None
+      self.tracer.info("[%s] converting %d records into JSON format" % (self.fullName,
+                                                                       len(records)))
+      jsonRecords = []
+      try:
+         for record in records:
+            jsonRecords.append(json.dumps(record, sort_keys=True, separators=(",", ":"), cls=JsonEncoder))
+         self.tracer.debug("[%s] resultJson=%s", self.fullName, TracePayload(jsonRecords))
+      except Exception as e:
+         self.tracer.error("[%s] could not format record=%s into JSON (%s)" % (self.fullName,
+                                                                               record,
+                                                                               e))
+      return jsonRecords
 
    # Method that gets called when the internal state is updated
    @abstractmethod
@@ -1,7 +1,10 @@
 # Python modules
+import codecs
+from collections import OrderedDict
 from datetime import datetime,timezone
 import json
 import logging
+import time
 import uuid
 import re
 import urllib
@@ -11,13 +14,14 @@ from requests.exceptions import Timeout
 # Payload modules
 from const import PAYLOAD_VERSION
 from helper.context import *
-from helper.tools import JsonEncoder
+from helper.contentregistry import ContentRegistry
+from helper.tools import HttpSession, JsonEncoder, calculateResultDigest
 from provider.base import ProviderInstance, ProviderCheck
-from typing import Dict, List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Pattern
 
 # provider specific modules
 from prometheus_client.samples import Sample
-from prometheus_client.parser import text_string_to_metric_families
+from prometheus_client.parser import text_fd_to_metric_families
 ###############################################################################
 
 # Default retry settings
@@ -25,10 +29,103 @@ RETRY_RETRIES = 3
 RETRY_DELAY_SECS   = 1
 RETRY_BACKOFF_MULTIPLIER = 2
 
+# Default number of checks per provider instance that may run in parallel
+MAX_CONCURRENT_CHECKS = 1
+
+# Scrape settings (only the text exposition format can be parsed, so protobuf is not requested)
+SCRAPE_ACCEPT_HEADER    = "text/plain;version=0.0.4;q=1,*/*;q=0.1"
+SCRAPE_CHUNK_SIZE       = 64 * 1024
+SCRAPE_MAX_BODY_BYTES   = 32 * 1024 * 1024
+
+# Maximum number of label sets whose JSON serialization is cached (per check)
+LABEL_CACHE_MAX_SIZE    = 100000
+
+# Suffixes of the sample names that belong to a metric family of the given type
+FAMILY_SAMPLE_SUFFIXES  = {
+    "counter":        ("_total", "_created"),
+    "summary":        ("_sum", "_count", "_created"),
+    "histogram":      ("_bucket", "_sum", "_count", "_created"),
+    "gaugehistogram": ("_bucket", "_gsum", "_gcount"),
+    "info":           ("_info",),
+}
+
+###############################################################################
+
+# Only pass on the lines (text exposition format) of metric families whose name is accepted by isFamilyIncluded,
+# so the samples of all other families are skipped without being parsed
+def filter_metric_family_lines(lines: Iterable[str],
+                               isFamilyIncluded: Callable[[str], bool]) -> Iterator[str]:
+    familyName = None
+    sampleSuffixes = ()
+    isIncluded = False
+    for line in lines:
+        if line.startswith("#"):
+            # Family names are announced by HELP and TYPE; all other comments are dropped
+            parts = line.split(None, 3)
+            if len(parts) < 3 or parts[1] not in ("HELP", "TYPE"):
+                continue
+            if parts[2] != familyName:
+                familyName = parts[2]
+                sampleSuffixes = ()
+                isIncluded = isFamilyIncluded(familyName)
+            if parts[1] == "TYPE" and len(parts) > 3:
+                sampleSuffixes = FAMILY_SAMPLE_SUFFIXES.get(parts[3].strip(), ())
+        elif not line.strip():
+            continue
+        else:
+            # Samples without HELP/TYPE (or whose name is neither the family name nor the family name with
+            # one of the suffixes of its type) start a new untyped family
+            sampleName = line.split("{", 1)[0].split(None, 1)[0]
+            if familyName is None or \
+               (sampleName != familyName and sampleName not in (familyName + suffix for suffix in sampleSuffixes)):
+                familyName = sampleName
+                sampleSuffixes = ()
+                isIncluded = isFamilyIncluded(familyName)
+        if isIncluded:
+            yield line
+
+# Bounded LRU cache of serialized label sets (the same label sets occur in every scrape)
+class LabelCache:
+    def __init__(self,
+                 maxSize: int = LABEL_CACHE_MAX_SIZE):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+
+    # Get the JSON serialization of a label set
+    def serialize(self,
+                  labels: Dict[str, str]) -> str:
+        key = tuple(sorted(labels.items()))
+        labelsJson = self.entries.get(key, None)
+        if labelsJson is None:
+            labelsJson = json.dumps(labels, separators=(',',':'), sort_keys=True, cls=JsonEncoder)
+            self.entries[key] = labelsJson
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last = False)
+        else:
+            self.entries.move_to_end(key)
+        return labelsJson
+
+# Raised while receiving a scrape whose body exceeds the maximum size (retrying would not help)
+class ScrapeTooLargeError(Exception):
+    pass
+
+# Result of a scrape: the lines of all included metric families, and how long/large the scrape was
+class PrometheusScrape:
+    def __init__(self,
+                 lines: List[str],
+                 durationSecs: float,
+                 bodyBytes: int,
+                 isTooLarge: bool = False):
+        self.lines = lines
+        self.durationSecs = durationSecs
+        self.bodyBytes = bodyBytes
+        self.isTooLarge = isTooLarge
+
 ###############################################################################
 
 class prometheusProviderInstance(ProviderInstance):
     metricsUrl = None
+    maxBodyBytes = SCRAPE_MAX_BODY_BYTES
     HTTP_TIMEOUT = (2, 5) # timeouts: 2s connect, 5s read
 
     def __init__(self,
@@ -49,6 +146,7 @@ class prometheusProviderInstance(ProviderInstance):
                          providerInstance,
                          retrySettings,
                          skipContent,
+                         maxConcurrentChecks = MAX_CONCURRENT_CHECKS,
                          **kwargs)
 
     def parseProperties(self):
@@ -58,20 +156,77 @@ class prometheusProviderInstance(ProviderInstance):
             self.tracer.error("[%s] PrometheusUrl cannot be empty" % self.fullName)
             return False
         self.instance_name = urllib.parse.urlparse(self.metricsUrl).netloc
+        maxBodyBytes = self.providerProperties.get("prometheusMaxScrapeBytes", SCRAPE_MAX_BODY_BYTES)
+        try:
+            self.maxBodyBytes = int(maxBodyBytes)
+        except (TypeError, ValueError):
+            self.maxBodyBytes = 0
+        if self.maxBodyBytes <= 0:
+            self.tracer.error("[%s] prometheusMaxScrapeBytes must be a positive integer (got %s)" % (self.fullName,
+                                                                                                    maxBodyBytes))
+            return False
         return True
 
     def validate(self) -> bool:
         self.tracer.info("fetching data from %s to validate connection" % self.metricsUrl)
-        return bool(self.fetch_metrics())
+        scrape = self.fetch_metrics()
+        return bool(scrape) and not scrape.isTooLarge
+
+    # Split the (decompressed) response body into lines while it is being received,
+    # and stop reading once it exceeds the maximum body size
+    def _iter_response_lines(self,
+                             resp: requests.Response,
+                             scrape: PrometheusScrape) -> Iterator[str]:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+        pendingLine = ""
+        for chunk in resp.iter_content(chunk_size = SCRAPE_CHUNK_SIZE):
+            scrape.bodyBytes += len(chunk)
+            if scrape.bodyBytes > self.maxBodyBytes:
+                raise ScrapeTooLargeError("response body exceeds %d bytes" % self.maxBodyBytes)
+            lines = (pendingLine + decoder.decode(chunk)).split("\n")
+            pendingLine = lines.pop()
+            yield from lines
+        pendingLine += decoder.decode(b"", final = True)
+        if pendingLine:
+            yield pendingLine
 
-    def fetch_metrics(self) -> str:
+    # Scrape the metrics endpoint (gzip-compressed, if supported by the exporter)
+    # Only the lines of metric families accepted by isFamilyIncluded are kept
+    # Returns None if the scrape failed, or a scrape without lines (isTooLarge) if its body exceeded the maximum size
+    def fetch_metrics(self,
+                      isFamilyIncluded: Optional[Callable[[str], bool]] = None) -> Optional[PrometheusScrape]:
+        scrape = PrometheusScrape([], 0, 0)
+        startTime = time.monotonic()
         try:
-            resp = requests.get(self.metricsUrl, timeout = self.HTTP_TIMEOUT)
-            resp.raise_for_status()
-            return resp.text
+            headers = {
+                "Accept": SCRAPE_ACCEPT_HEADER,
+                "Accept-Encoding": "gzip"
+            }
+            with HttpSession().request("GET",
+                                       self.metricsUrl,
+                                       headers = headers,
+                                       timeout = self.HTTP_TIMEOUT,
+                                       stream = True) as resp:
+                resp.raise_for_status()
+                lines = self._iter_response_lines(resp, scrape)
+                if isFamilyIncluded:
+                    lines = filter_metric_family_lines(lines, isFamilyIncluded)
+                scrape.lines = list(lines)
+        except ScrapeTooLargeError as err:
+            self.tracer.error("[%s] discarding scrape of %s (%s)" % (self.fullName,
+                                                                     self.metricsUrl,
+                                                                     err))
+            scrape.lines = []
+            scrape.isTooLarge = True
         except Exception as err:
             self.tracer.info("Failed to fetch %s (%s)" % (self.metricsUrl, err))
             return None
+        scrape.durationSecs = time.monotonic() - startTime
+        self.tracer.debug("[%s] scraped %d bytes in %.3fs (%d lines kept)" % (self.fullName,
+                                                                             scrape.bodyBytes,
+                                                                             scrape.durationSecs,
+                                                                             len(scrape.lines)))
+        return scrape
 
     @property
     def instance(self):
@@ -81,22 +236,27 @@ class prometheusProviderInstance(ProviderInstance):
 class prometheusProviderCheck(ProviderCheck):
     colTimeGenerated = "TimeGeneratedPrometheus"
     excludeRegex = re.compile(r"^(?:go|promhttp|process)_")
-    lastResult = ([], None)
+    lastResult = (None, None, None, False)
+    volatileFields = ("correlation_id",)
+    labelCache = None
 
     def __init__(self,
                  provider: ProviderInstance,
                  **kwargs):
+        self.labelCache = LabelCache()
         return super().__init__(provider, **kwargs)
 
 
     def _actionFetchMetrics(self,
                             includePrefixes: str,
-                            suppressIfZeroPrefixes: str = None) -> None:
+                            suppressIfZeroPrefixes: str = None,
+                            compactSchema: bool = False) -> None:
         # Helper method to streamline regular expression compilation and checks
+        # (patterns are compiled only once per process)
         def compile_regexp(pattern, patternName = "Pattern"):
             if pattern:
                 try:
-                    return re.compile(pattern)
+                    return ContentRegistry().getRegex(pattern)
                 except re.error as e:
                     raise Exception("%s (%s) must be a valid regular expression: %s" %
                                       (patternName, e.pattern, e.msg))
@@ -104,20 +264,47 @@ class prometheusProviderCheck(ProviderCheck):
         self.tracer.info("[%s] Fetching metrics" % self.fullName)
         includeRegex = compile_regexp(includePrefixes, "includePrefixes")
         suppressIfZeroRegex = compile_regexp(suppressIfZeroPrefixes, "suppressIfZeroPrefixes")
-        metricsData = self.providerInstance.fetch_metrics()
-        self.lastResult = (metricsData, includeRegex, suppressIfZeroRegex)
+        # Metric families are filtered by name while the scrape is received (before their samples are parsed)
+        metricsData = self.providerInstance.fetch_metrics(lambda name: self._isFamilyIncluded(name, includeRegex))
+        self.lastResult = (metricsData, includeRegex, suppressIfZeroRegex, compactSchema)
+        # An oversized scrape is not retried (it is reported with up=0 instead)
         if metricsData is None:
             raise Exception("Unable to fetch metrics")
         if not self.updateState():
             raise Exception("Failed to update state")
 
-    # Convert last result into a JSON string (as required by Log Analytics Data Collector API)
-    def generateJsonString(self) -> str:
+    def _isFamilyIncluded(self,
+                          name: str,
+                          includeRegex: Optional[Pattern]) -> bool:
+        """
+        Filter out names based on our exclude and include lists
+        """
+        # Remove everything matching excludeRegex
+        if self.excludeRegex.match(name):
+            return False
+
+        # If includeRegex is defined, filter out everything NOT matching
+        if (includeRegex is not None and
+                includeRegex.match(name) is None):
+            return False
+
+        # If none of the above matched, just let the item through
+        return True
+
+    # Convert last result into records (as required by Log Analytics Data Collector API)
+    def generateRecords(self) -> List[Dict]:
         # The correlation_id can be used to group fields from the same metrics call
         correlation_id = str(uuid.uuid4())
         fallback_datetime = datetime.now(timezone.utc)
 
-        def prometheusSample2Dict(sample):
+        # Fields that are the same for all samples of a scrape
+        # (with the compact schema, only the sapmon sample carries them; join on correlation_id)
+        scrapeFields = {
+            "instance": self.providerInstance.instance,
+            "metadata": self.providerInstance.metadata
+        }
+
+        def prometheusSample2Dict(sample, includeScrapeFields = True):
             """
             Convert a prometheus metric sample to Python dictionary for serialization
             """
@@ -126,15 +313,18 @@ class prometheusProviderCheck(ProviderCheck):
                 TimeGenerated = datetime.fromtimestamp(sample.timestamp, tz=timezone.utc)
             sample_dict = {
                 "name" : sample.name,
-                "labels" : json.dumps(sample.labels, separators=(',',':'), sort_keys=True, cls=JsonEncoder),
+                "labels" : self.labelCache.serialize(sample.labels),
                 "value" : sample.value,
                 self.colTimeGenerated: TimeGenerated,
-                "instance": self.providerInstance.instance,
-                "metadata": self.providerInstance.metadata,
                 "correlation_id": correlation_id
             }
+            if includeScrapeFields:
+                sample_dict.update(scrapeFields)
             return sample_dict
 
+        def prometheusSample2CompactDict(sample):
+            return prometheusSample2Dict(sample, includeScrapeFields = not compactSchema)
+
         def filter_prometheus_sample(sample):
             """
             Filter out samples matching suppressIfZeroRegex with value == 0
@@ -147,61 +337,54 @@ class prometheusProviderCheck(ProviderCheck):
 
         def filter_prometheus_metric(metric):
             """
-            Filter out names based on our exclude and include lists
+            Filter out metric families based on their parsed name (e.g. counters without _total)
             """
-            # Remove everything matching excludeRegex
-            if self.excludeRegex.match(metric.name):
-                return False
-
-            # If includeRegex is defined, filter out everything NOT matching
-            if (includeRegex is not None and
-                    includeRegex.match(metric.name) is None):
-                return False
+            return self._isFamilyIncluded(metric.name, includeRegex)
 
-            # If none of the above matched, just let the item through
-            return True
-
-        prometheusMetricsText = self.lastResult[0]
+        scrape = self.lastResult[0]
         includeRegex = self.lastResult[1]
         suppressIfZeroRegex = self.lastResult[2]
+        compactSchema = self.lastResult[3]
         resultSet = list()
 
         self.tracer.info("[%s] converting result set into JSON" % self.fullName)
         try:
-            if not prometheusMetricsText:
+            if not scrape or not scrape.bodyBytes:
                 raise ValueError("Empty result from prometheus instance %s", self.providerInstance.instance)
+            if scrape.isTooLarge:
+                raise ValueError("Scrape of prometheus instance %s exceeds %d bytes" % (self.providerInstance.instance,
+                                                                                         self.providerInstance.maxBodyBytes))
+            # Families have already been filtered by name while scraping; samples are parsed lazily
             for family in filter(filter_prometheus_metric,
-                                 text_string_to_metric_families(prometheusMetricsText)):
-                resultSet.extend(map(prometheusSample2Dict, filter(filter_prometheus_sample, family.samples)))
+                                 text_fd_to_metric_families(iter(scrape.lines))):
+                resultSet.extend(map(prometheusSample2CompactDict, filter(filter_prometheus_sample, family.samples)))
         except ValueError as e:
-            self.tracer.error("[%s] Could not parse prometheus metrics (%s): %s" % (self.fullName, e, prometheusMetricsText))
-            resultSet.append(prometheusSample2Dict(Sample("up", dict(), 0)))
+            self.tracer.error("[%s] Could not parse prometheus metrics (%s): %s", self.fullName, e, TracePayload(scrape.lines if scrape else None))
+            resultSet.append(prometheusSample2CompactDict(Sample("up", dict(), 0)))
         else:
             # The up-metric is used to determine whatever valid data could be read from
             # the prometheus endpoint and is used by prometheus in a similar way
-            resultSet.append(prometheusSample2Dict(Sample("up", dict(), 1)))
+            resultSet.append(prometheusSample2CompactDict(Sample("up", dict(), 1)))
+        if scrape:
+            resultSet.append(prometheusSample2CompactDict(Sample("sapmon_scrape_duration_seconds", dict(), scrape.durationSecs)))
+            resultSet.append(prometheusSample2CompactDict(Sample("sapmon_scrape_size_bytes", dict(), scrape.bodyBytes)))
         resultSet.append(prometheusSample2Dict(
             Sample("sapmon",
                    {
                        "SAPMON_VERSION": PAYLOAD_VERSION,
                        "PROVIDER_INSTANCE": self.providerInstance.name
                    }, 1)))
-        # Convert temporary dictionary into JSON string
-        try:
-            # Use a very compact json representation to limit amount of data parsed by LA
-            resultJsonString = json.dumps(resultSet, sort_keys=True,
-                                          separators=(',',':'),
-                                          cls=JsonEncoder)
-            self.tracer.debug("[%s] resultJson=%s" % (self.fullName, str(resultJsonString)[:1000]))
-        except Exception as e:
-            self.tracer.error("[%s] could not format logItem=%s into JSON (%s)" % (self.fullName,
-                                                                                   resultSet[:50],
-                                                                                   e))
-        return resultJsonString
+        return resultSet
+
+    # Get the hash of the lines kept from the last scrape (used to detect unchanged results)
+    def getResultHash(self) -> Optional[str]:
+        return self.state.get("lastResultHash", None)
 
     # Update the internal state of this check (including last run times)
     def updateState(self) -> bool:
         self.tracer.info("[%s] updating internal state" % self.fullName)
         self.state["lastRunLocal"] = datetime.utcnow()
+        scrape = self.lastResult[0]
+        self.state["lastResultHash"] = calculateResultDigest([(line,) for line in scrape.lines], [0]) if scrape else None
         self.tracer.info("[%s] internal state successfully updated" % self.fullName)
         return True
@@ -1,8 +1,12 @@
 # Python modules
-import hashlib
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 import json
 import logging
 import re
+import socket
+import threading
 import time
 
 # Payload modules
@@ -11,7 +15,7 @@ from helper.azure import *
 from helper.context import *
 from helper.tools import *
 from provider.base import ProviderInstance, ProviderCheck
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 # SAP HANA modules
 from hdbcli import dbapi
@@ -22,15 +26,194 @@ import pyhdbcli
 # HANA-specific constants
 REGEX_EXTERNAL_KEYVAULT_URL = "https://([A-Za-z0-9\-]+).vault.azure.net/secrets/([A-Za-z0-9\-]+)(\/)?([A-Za-z0-9\-]+)?"
 TIMEOUT_HANA_SECS           = 5
+TIMEOUT_HANA_MS             = TIMEOUT_HANA_SECS * 1000
+HANA_ROLE_MASTER            = "MASTER"
 COL_LOCAL_UTC               = "_LOCAL_UTC"
 COL_SERVER_UTC              = "_SERVER_UTC"
 COL_TIMESERIES_UTC          = "_TIMESERIES_UTC"
 
+# Placeholders for the bounds of time series queries (bound as parameters of a prepared statement)
+SQL_PARAM_LOWER_BOUND       = "{lastRunServerUtc}"
+SQL_PARAM_UPPER_BOUND       = "{upperBoundUtc}"
+SQL_SERVER_UTC              = "SELECT CURRENT_UTCTIMESTAMP FROM DUMMY"
+
 # Default retry settings
 RETRY_RETRIES = 3
 RETRY_DELAY_SECS   = 1
 RETRY_BACKOFF_MULTIPLIER = 2
 
+# Default number of checks per provider instance that may run in parallel
+MAX_CONCURRENT_CHECKS = 3
+
+# Default connection pool settings
+POOL_MAX_IDLE_SECS = 300
+POOL_MAX_AGE_SECS  = 3600
+
+# Probing settings (the overall deadline is a multiple of the probe timeout, unless defined explicitly)
+PROBE_MODE_SQL        = "sql"
+PROBE_MODE_TCP        = "tcp"
+PROBE_MAX_PARALLEL    = 8
+PROBE_DEADLINE_FACTOR = 2
+
+# Delay between staggered connection attempts to the HANA hosts
+CONNECT_STAGGER_SECS = 1
+
+# Max number of prepared statements kept per pooled connection
+MAX_PREPARED_STATEMENTS = 32
+
+# Max number of time series windows (pages) fetched per run while catching up
+MAX_WINDOWS_PER_RUN = 24
+
+###############################################################################
+
+# HANA connection (and the host it is connected to) managed by a connection pool
+class PooledHanaConnection:
+   def __init__(self,
+                connection: pyhdbcli.Connection,
+                host: str):
+      self.connection = connection
+      self.host = host
+      self.createdTime = time.monotonic()
+      self.lastUsedTime = self.createdTime
+      self.preparedCursors = OrderedDict()
+
+   # Get a cursor with a prepared SQL statement
+   # Statements are prepared once per connection and reused by subsequent runs (least recently used ones are closed)
+   def getPreparedCursor(self,
+                         sql: str,
+                         maxStatements: int = MAX_PREPARED_STATEMENTS) -> dbapi.Cursor:
+      cursor = self.preparedCursors.pop(sql, None)
+      if not cursor:
+         cursor = self.connection.cursor()
+         cursor.prepare(sql)
+         while len(self.preparedCursors) >= maxStatements:
+            (_, evictedCursor) = self.preparedCursors.popitem(last = False)
+            self._closeCursor(evictedCursor)
+      self.preparedCursors[sql] = cursor
+      return cursor
+
+   # Drop a prepared statement (e.g. after it failed, so it will be prepared again)
+   def discardPreparedCursor(self,
+                             sql: str) -> None:
+      cursor = self.preparedCursors.pop(sql, None)
+      if cursor:
+         self._closeCursor(cursor)
+
+   # Execute a prepared SQL statement with the given bind parameters and fetch its result
+   def executePrepared(self,
+                       sql: str,
+                       parameters: List[object]) -> Tuple[List[Tuple], List[List[object]]]:
+      cursor = self.getPreparedCursor(sql)
+      try:
+         cursor.executeprepared(parameters)
+         description = cursor.description
+         resultRows = cursor.fetchall()
+      except Exception:
+         self.discardPreparedCursor(sql)
+         raise
+      return (description, resultRows)
+
+   @staticmethod
+   def _closeCursor(cursor: dbapi.Cursor) -> None:
+      try:
+         cursor.close()
+      except Exception:
+         pass
+
+# Pool of HANA connections shared across all checks of a provider instance
+class HanaConnectionPool:
+   def __init__(self,
+                providerInstance: "saphanaProviderInstance",
+                maxIdleSecs: int = POOL_MAX_IDLE_SECS,
+                maxAgeSecs: int = POOL_MAX_AGE_SECS):
+      self.providerInstance = providerInstance
+      self.tracer = providerInstance.tracer
+      self.maxIdleSecs = maxIdleSecs
+      self.maxAgeSecs = maxAgeSecs
+      self.idleConnections = []
+      self.lock = threading.Lock()
+
+   # Determine if a pooled connection can still be used
+   def _isUsable(self,
+                 pooledConnection: PooledHanaConnection) -> bool:
+      now = time.monotonic()
+      if now - pooledConnection.createdTime > self.maxAgeSecs:
+         self.tracer.debug("[%s] pooled connection to %s exceeded max age" % (self.providerInstance.fullName,
+                                                                             pooledConnection.host))
+         return False
+      if now - pooledConnection.lastUsedTime > self.maxIdleSecs:
+         self.tracer.debug("[%s] pooled connection to %s exceeded max idle time" % (self.providerInstance.fullName,
+                                                                                   pooledConnection.host))
+         return False
+      # After a takeover, connections to the former primary are replaced by ones to the new primary
+      preferredHosts = self.providerInstance._getHostsToTry()
+      if preferredHosts and pooledConnection.host != preferredHosts[0]:
+         self.tracer.debug("[%s] pooled connection to %s is not connected to primary host %s" % (self.providerInstance.fullName,
+                                                                                                pooledConnection.host,
+                                                                                                preferredHosts[0]))
+         return False
+      try:
+         return pooledConnection.connection.isconnected()
+      except Exception:
+         return False
+
+   # Close a connection that is no longer used
+   def _close(self,
+              pooledConnection: PooledHanaConnection) -> None:
+      try:
+         pooledConnection.connection.close()
+      except Exception as e:
+         self.tracer.debug("[%s] could not close HANA connection to %s (%s)" % (self.providerInstance.fullName,
+                                                                               pooledConnection.host,
+                                                                               e))
+
+   # Get a healthy connection from the pool or establish a new one
+   def acquire(self) -> PooledHanaConnection:
+      while True:
+         with self.lock:
+            if not self.idleConnections:
+               break
+            pooledConnection = self.idleConnections.pop()
+         if self._isUsable(pooledConnection):
+            self.tracer.debug("[%s] reusing pooled HANA connection to %s" % (self.providerInstance.fullName,
+                                                                             pooledConnection.host))
+            return pooledConnection
+         self._close(pooledConnection)
+
+      (connection, host) = self.providerInstance._connectToPreferredHost()
+      if not connection:
+         return None
+      return PooledHanaConnection(connection, host)
+
+   # Return a connection to the pool (unless it is no longer healthy)
+   def release(self,
+               pooledConnection: PooledHanaConnection) -> None:
+      pooledConnection.lastUsedTime = time.monotonic()
+      if not self._isUsable(pooledConnection):
+         self._close(pooledConnection)
+         return
+      with self.lock:
+         self.idleConnections.append(pooledConnection)
+
+   # Context manager to borrow a connection from the pool
+   @contextmanager
+   def connection(self):
+      pooledConnection = self.acquire()
+      if not pooledConnection:
+         raise Exception("Unable to get HANA connection")
+      try:
+         yield pooledConnection
+      finally:
+         self.release(pooledConnection)
+
+   # Close all idle connections
+   def closeAll(self) -> None:
+      with self.lock:
+         idleConnections = self.idleConnections
+         self.idleConnections = []
+      for pooledConnection in idleConnections:
+         self._close(pooledConnection)
+
 ###############################################################################
 
 class saphanaProviderInstance(ProviderInstance):
@@ -38,6 +221,7 @@ class saphanaProviderInstance(ProviderInstance):
    hanaDbSqlPort = None
    hanaDbUsername = None
    hanaDbPassword = None
+   connectionPool = None
 
    def __init__(self,
                 tracer: logging.Logger,
@@ -57,7 +241,11 @@ class saphanaProviderInstance(ProviderInstance):
                        providerInstance,
                        retrySettings,
                        skipContent,
+                       maxConcurrentChecks = MAX_CONCURRENT_CHECKS,
                        **kwargs)
+      self.connectionPool = HanaConnectionPool(self,
+                                               maxIdleSecs = self.providerProperties.get("hanaDbPoolMaxIdleSecs", POOL_MAX_IDLE_SECS),
+                                               maxAgeSecs = self.providerProperties.get("hanaDbPoolMaxAgeSecs", POOL_MAX_AGE_SECS))
 
    # Parse provider properties and fetch DB password from KeyVault, if necessary
    def parseProperties(self):
@@ -156,174 +344,311 @@ class saphanaProviderInstance(ProviderInstance):
                            user = self.hanaDbUsername,
                            password = self.hanaDbPassword,
                            timeout = timeout,
-                           CONNECTTIMEOUT = timeout * 1000)
+                           CONNECTTIMEOUT = int(timeout * 1000))
 
-###############################################################################
+   # Compile the prioritized list of HANA hosts to connect to
+   def _getHostsToTry(self) -> List[str]:
+      # Check if HANA host config has been retrieved from DB yet
+      if "hostConfig" not in self.state:
+         # Host config has not been retrieved yet; our only candidate is the one provided by user
+         return [self.hanaHostname]
+      # Host config has already been retrieved; the primary comes first
+      hostConfig = self.state["hostConfig"]
+      hostsToTry = [h["ip"] if h.get("ip", None) else h["host"] for h in hostConfig]
+      # The host of the last successful connection comes first (e.g. the new primary after a takeover)
+      lastGoodHost = self.state.get("lastGoodHost", None)
+      if lastGoodHost in hostsToTry:
+         hostsToTry.remove(lastGoodHost)
+         hostsToTry.insert(0, lastGoodHost)
+      return hostsToTry
+
+   # Determine if a host has the primary (master) role according to the host config
+   # (if the host config doesn't define any master, every host is accepted)
+   def _isPrimaryHost(self,
+                      host: str) -> bool:
+      hostConfig = self.state.get("hostConfig", None)
+      if not hostConfig:
+         return True
+      primaryHosts = set()
+      for h in hostConfig:
+         if str(h.get("role", "")).upper() == HANA_ROLE_MASTER:
+            primaryHosts.update([h.get("host", None), h.get("ip", None)])
+      return not primaryHosts or host in primaryHosts
+
+   # Close a connection that was established after another host has already been chosen
+   def _closeAbandonedConnection(self,
+                                 future: Future) -> None:
+      if future.cancelled() or future.exception():
+         return
+      try:
+         future.result().close()
+      except Exception as e:
+         self.tracer.debug("[%s] could not close abandoned HANA connection (%s)" % (self.fullName,
+                                                                                   e))
 
-# Implements a SAP HANA-specific monitoring check
-class saphanaProviderCheck(ProviderCheck):
-   lastResult = None
-   colTimeGenerated = None
-   
-   def __init__(self,
-                provider: ProviderInstance,
-                **kwargs):
-      return super().__init__(provider, **kwargs)
+   # Connect to the given hosts in parallel, starting one attempt after another ("happy eyeballs")
+   # The next attempt is started as soon as an attempt fails or after staggerSecs;
+   # the first connection to a primary host wins (otherwise the first connection to any host)
+   def _connectToAnyHost(self,
+                         hostsToTry: List[str],
+                         staggerSecs: float = CONNECT_STAGGER_SECS):
+      executor = ThreadPoolExecutor(max_workers = max(len(hostsToTry), 1),
+                                    thread_name_prefix = "%s-connect" % self.name)
+      pendingAttempts = {}
+      hostsLeft = list(hostsToTry)
+      (winner, fallback) = (None, None)
+      try:
+         while not winner and (hostsLeft or pendingAttempts):
+            if hostsLeft:
+               host = hostsLeft.pop(0)
+               self.tracer.debug("[%s] connecting to HANA node %s:%d" % (self.fullName,
+                                                                         host,
+                                                                         self.hanaDbSqlPort))
+               pendingAttempts[executor.submit(self._establishHanaConnectionToHost, hostname = host)] = host
+            (doneAttempts, _) = wait(pendingAttempts.keys(),
+                                     timeout = staggerSecs if hostsLeft else None,
+                                     return_when = FIRST_COMPLETED)
+            for future in doneAttempts:
+               host = pendingAttempts.pop(future)
+               try:
+                  connection = future.result()
+                  # Validate that we're indeed connected
+                  if not connection.isconnected():
+                     continue
+               except Exception as e:
+                  self.tracer.warning("[%s] could not connect to HANA node %s:%d (%s)" % (self.fullName,
+                                                                                          host,
+                                                                                          self.hanaDbSqlPort,
+                                                                                          e))
+                  continue
+               if not winner and self._isPrimaryHost(host):
+                  winner = (connection, host)
+               elif not winner and not fallback:
+                  fallback = (connection, host)
+               else:
+                  connection.close()
+      finally:
+         # Attempts that are still queued or running are not needed anymore
+         # (futures are cancelled one by one, as shutdown(cancel_futures) requires Python 3.9)
+         for future in pendingAttempts.keys():
+            future.cancel()
+            future.add_done_callback(self._closeAbandonedConnection)
+         executor.shutdown(wait = False)
+
+      if winner:
+         if fallback:
+            fallback[0].close()
+         return winner
+      if fallback:
+         self.tracer.warning("[%s] could not connect to a primary HANA node, using %s" % (self.fullName,
+                                                                                          fallback[1]))
+         return fallback
+      return (None, None)
 
    # Obtain one working HANA connection (client-side failover logic)
-   def _getHanaConnection(self):
+   def _connectToPreferredHost(self):
       self.tracer.info("[%s] establishing connection with HANA instance" % self.fullName)
 
-      # Check if HANA host config has been retrieved from DB yet
-      if "hostConfig" not in self.providerInstance.state:
-         # Host config has not been retrieved yet; our only candidate is the one provided by user
-         self.tracer.debug("[%s] no host config has been persisted yet, using user-provided host" % self.fullName)
-         hostsToTry = [self.providerInstance.hanaHostname]
-      else:
-         # Host config has already been retrieved; rank the hosts to compile a list of hosts to try
-         self.tracer.debug("[%s] host config has been persisted to provider, deriving prioritized host list" % self.fullName)
-         hostConfig = self.providerInstance.state["hostConfig"]
-         hostsToTry = [h["ip"] if h.get("ip", None) else h["host"] for h in hostConfig]
-
-      # Iterate through the prioritized list of hosts to try
-      cursor = None
+      # Try the prioritized list of hosts (staggered, in parallel)
+      hostsToTry = self._getHostsToTry()
       self.tracer.debug("hostsToTry=%s" % hostsToTry)
-      for host in hostsToTry:
-         try:
-            connection = self.providerInstance._establishHanaConnectionToHost(hostname = host)
-            # Validate that we're indeed connected
-            if connection.isconnected():
-               cursor = connection.cursor()
-               break
-         except Exception as e:
-            self.tracer.warning("[%s] could not connect to HANA node %s:%d (%s)" % (self.fullName,
-                                                                                    host,
-                                                                                    self.providerInstance.hanaDbSqlPort,
-                                                                                    e))
-      # If we were able to establish a connection, we're done
-      if cursor:
-         return (connection, cursor, host)
+      (connection, host) = self._connectToAnyHost(hostsToTry)
+      if connection:
+         # Remember this host, so the next connection attempt starts with it (only if it is a primary host;
+         # otherwise, the next attempt and the pooled connections have to prefer the primary hosts again)
+         if self._isPrimaryHost(host):
+            self.setState("lastGoodHost", host)
+         else:
+            self.popState("lastGoodHost")
+         return (connection, host)
 
       # Our last chance: Forget HANA's current host config and try out the original user config
       self.tracer.error("[%s] unable to connect to any HANA node (hosts to try=%s)" % (self.fullName,
                                                                                        hostsToTry))
       self.tracer.info("[%s] trying with connection from user config" % self.fullName)
       try:
-         connection = self.providerInstance._establishHanaConnectionToHost(hostname = self.providerInstance.hanaHostname)
+         connection = self._establishHanaConnectionToHost(hostname = self.hanaHostname)
          if connection.isconnected():
-            cursor = connection.cursor()
             self.tracer.info("[%s] connection %s:%d from user config worked; forgetting host config" % (self.fullName,
-                                                                                                        self.providerInstance.hanaHostname,
-                                                                                                        self.providerInstance.hanaDbSqlPort))
+                                                                                                        self.hanaHostname,
+                                                                                                        self.hanaDbSqlPort))
             # Give up and remove current host config, so a "fresh" host config will be pulled next time
             # This is for HA/DR scenarios where customers connected against a vIP and a failover just happened
-            self.providerInstance.state.pop("hostConfig")
-            # Update internal state
-            if not self.updateState():
-               raise Exception("Failed to update state")
+            self.popState("hostConfig")
+            self.popState("lastGoodHost")
             # Return (temporary) connection from user config
-            return (connection, cursor, self.providerInstance.hanaHostname)
+            return (connection, self.hanaHostname)
       except Exception as e:
          self.tracer.error("[%s] %s:%d from user config is also unreachable (%s)" % (self.fullName,
-                                                                                     self.providerInstance.hanaHostname,
-                                                                                     self.providerInstance.hanaDbSqlPort,
+                                                                                     self.hanaHostname,
+                                                                                     self.hanaDbSqlPort,
                                                                                      e))
-      return (None, None, None)
+      return (None, None)
+
+   # Close all pooled HANA connections
+   def close(self) -> None:
+      self.connectionPool.closeAll()
+      super().close()
+
+###############################################################################
+
+# Implements a SAP HANA-specific monitoring check
+class saphanaProviderCheck(ProviderCheck):
+   lastResult = None
+   lastResultEncoders = []
+   lastUpperBound = None
+   colTimeGenerated = None
+   
+   def __init__(self,
+                provider: ProviderInstance,
+                **kwargs):
+      return super().__init__(provider, **kwargs)
 
    # Prepare the SQL statement based on the check-specific query
+   # The bounds of time series queries are bind parameters, so the statement text is the same for every run
+   # and HANA can reuse its plan; returns the statement and the names of its parameters (in order)
    def _prepareSql(self,
                    sql: str,
-                   isTimeSeries: bool,
-                   initialTimespanSecs: int) -> str:
+                   isTimeSeries: bool) -> Tuple[str, List[str]]:
       self.tracer.info("[%s] preparing SQL statement" % self.fullName)
 
       # Insert logic to get server UTC time (_SERVER_UTC)
       sqlTimestamp = ", CURRENT_UTCTIMESTAMP AS %s FROM DUMMY," % COL_SERVER_UTC
-      self.tracer.debug("[%s] sqlTimestamp=%s" % (self.fullName,
-                                                  sqlTimestamp))
+      self.tracer.debug("[%s] sqlTimestamp=%s", self.fullName, sqlTimestamp)
       preparedSql = sql.replace(" FROM", sqlTimestamp, 1)
-      
-      # If time series, insert time condition
-      if isTimeSeries:
-         lastRunServer = self.state.get("lastRunServer", None)
+      parameters = []
 
-         # TODO(tniek) - make WHERE conditions for time series queries more flexible
-         if not lastRunServer:
-            self.tracer.info("[%s] time series query has never been run, applying initalTimespanSecs=%d" % \
-               (self.fullName, initialTimespanSecs))
-            lastRunServerUtc = "LOCALTOUTC(ADD_SECONDS(NOW(), -%d))" % initialTimespanSecs
-         else:
-            if not isinstance(lastRunServer, datetime):
-               self.tracer.error("[%s] lastRunServer=%s could not been de-serialized into datetime object" % (self.fullName,
-                                                                                                              str(lastRunServer)))
-               return None
-            try:
-               lastRunServerUtc = "'%s'" % lastRunServer.strftime(TIME_FORMAT_HANA)
-            except Exception as e:
-               self.tracer.error("[%s] could not format lastRunServer=%s into HANA format (%s)" % (self.fullName,
-                                                                                                   str(lastRunServer),
-                                                                                                   e))
-               return None
-            self.tracer.info("[%s] time series query has been run at %s, filter out only new records since then" % \
-               (self.fullName, lastRunServerUtc))
-         self.tracer.debug("[%s] lastRunServerUtc=%s" % (self.fullName,
-                                                         lastRunServerUtc))
-         preparedSql = sql.replace("{lastRunServerUtc}", lastRunServerUtc, 1)
-         self.tracer.debug("[%s] preparedSql=%s" % (self.fullName,
-                                                    preparedSql))
+      # If time series, replace the time conditions with bind parameters
+      if isTimeSeries:
+         preparedSql = sql
+         placeholders = [p for p in (SQL_PARAM_LOWER_BOUND, SQL_PARAM_UPPER_BOUND) if p in sql]
+         for placeholder in sorted(placeholders, key = lambda p: sql.index(p)):
+            preparedSql = preparedSql.replace(placeholder, "?", 1)
+            parameters.append(placeholder)
+      self.tracer.debug("[%s] preparedSql=%s", self.fullName, TracePayload(preparedSql))
 
       # Return the finished SQL statement
-      return preparedSql
-
-   # Calculate the MD5 hash of a result set
+      return (preparedSql, parameters)
+
+   # Get the windows (lower and upper bound) of a time series query for this run
+   # Without an upper bound, all records since the last run are fetched at once; otherwise records are
+   # fetched in windows of at most maxWindowSecs, up to safetyLagSecs before the current server time
+   def _getTimeSeriesWindows(self,
+                             pooledConnection: PooledHanaConnection,
+                             hasUpperBound: bool,
+                             initialTimespanSecs: int,
+                             safetyLagSecs: int,
+                             maxWindowSecs: Optional[int],
+                             maxWindowsPerRun: int) -> List[Tuple[datetime, Optional[datetime]]]:
+      lastRunServer = self.state.get("lastRunServer", None)
+      if lastRunServer and not isinstance(lastRunServer, datetime):
+         raise ValueError("lastRunServer=%s could not been de-serialized into datetime object" % str(lastRunServer))
+
+      # The current server time is only queried if it's needed
+      serverUtc = None
+      if not lastRunServer or hasUpperBound:
+         (_, resultRows) = pooledConnection.executePrepared(SQL_SERVER_UTC, [])
+         serverUtc = resultRows[0][0]
+      if not lastRunServer:
+         self.tracer.info("[%s] time series query has never been run, applying initalTimespanSecs=%d" % \
+            (self.fullName, initialTimespanSecs))
+         lastRunServer = serverUtc - timedelta(seconds = initialTimespanSecs)
+      else:
+         self.tracer.info("[%s] time series query has been run at %s, filter out only new records since then" % \
+            (self.fullName, lastRunServer))
+      if not hasUpperBound:
+         return [(lastRunServer, None)]
+
+      windows = []
+      lowerBound = lastRunServer
+      endUtc = max(serverUtc - timedelta(seconds = safetyLagSecs), lowerBound)
+      while len(windows) < max(maxWindowsPerRun, 1):
+         upperBound = min(lowerBound + timedelta(seconds = maxWindowSecs), endUtc) if maxWindowSecs else endUtc
+         windows.append((lowerBound, upperBound))
+         if upperBound >= endUtc:
+            break
+         lowerBound = upperBound
+      if windows[-1][1] < endUtc:
+         self.tracer.info("[%s] time series query is catching up, fetching %d windows until %s" % (self.fullName,
+                                                                                                  len(windows),
+                                                                                                  windows[-1][1]))
+      return windows
+
+   # Calculate the digest of a result set (only internal columns, e.g. timestamps of the query, are ignored)
    def _calculateResultHash(self,
-                            resultRows: List[List[str]]) -> str:
+                            colIndex: Dict[str, int],
+                            resultRows: List[List[object]]) -> str:
       self.tracer.info("[%s] calculating hash of SQL query result" % self.fullName)
       if len(resultRows) == 0:
          self.tracer.debug("[%s] result set is empty" % self.fullName)
          return None
       resultHash = None
       try:
-         resultHash = hashlib.md5(str(resultRows).encode("utf-8")).hexdigest()
-         self.tracer.debug("resultHash=%s" % resultHash)
+         columnIndices = [idx for (c, idx) in colIndex.items() if not (c.startswith("_") or c == "DUMMY")]
+         resultHash = calculateResultDigest(resultRows, columnIndices)
+         self.tracer.debug("[%s] resultHash=%s", self.fullName, resultHash)
       except Exception as e:
          self.tracer.error("[%s] could not calculate result hash (%s)" % (self.fullName,
                                                                           e))
       return resultHash
 
-   # Generate a JSON-encoded string with the last query result
-   # This string will be ingested into Log Analytics and Customer Analytics
-   def generateJsonString(self) -> str:
-      self.tracer.info("[%s] converting SQL query result set into JSON format" % self.fullName)
-      logData = []
+   # Get the hash of the last query result (used to detect unchanged results)
+   def getResultHash(self) -> Optional[str]:
+      return self.state.get("lastResultHash", None)
 
-      # Only loop through the result if there is one
+   # Get the key and fingerprint of each row of the last query result (in the same order as the records)
+   def generateRowFingerprints(self) -> Optional[List[Tuple[str, str]]]:
+      if not self.lastResult:
+         return None
+      (colIndex, resultRows) = self.lastResult
+      keyIndices = [colIndex[c] for c in self.deltaKeyColumns]
+      columnIndices = [idx for (c, idx) in colIndex.items() if not (c.startswith("_") or c == "DUMMY")]
+      return calculateRowFingerprints(resultRows, keyIndices, columnIndices)
+
+   # Convert the last query result into records (one dictionary per row)
+   def generateRecords(self) -> List[Dict]:
+      records = []
       if self.lastResult:
          (colIndex, resultRows) = self.lastResult
-         # Iterate through all rows of the last query result
+         # Unless it's the column mapped to TimeGenerated, remove internal fields
+         columns = [(c, idx) for (c, idx) in colIndex.items() \
+            if c == self.colTimeGenerated or not (c.startswith("_") or c == "DUMMY")]
          for r in resultRows:
-            logItem = {
+            record = {
                "SAPMON_VERSION": PAYLOAD_VERSION,
                "PROVIDER_INSTANCE": self.providerInstance.name,
                "METADATA": self.providerInstance.metadata
             }
-            for c in colIndex.keys():
-               # Unless it's the column mapped to TimeGenerated, remove internal fields
-               if c != self.colTimeGenerated and (c.startswith("_") or c == "DUMMY"):
-                  continue
-               logItem[c] = r[colIndex[c]]
-            logData.append(logItem)
+            for (c, idx) in columns:
+               record[c] = r[idx]
+            records.append(record)
+      return records
+
+   # Encode the last query result into JSON records (one per row), without building a dictionary per row
+   # These records will be ingested into Log Analytics and Customer Analytics
+   def generateJsonRecords(self) -> List[str]:
+      self.tracer.info("[%s] converting SQL query result set into JSON format" % self.fullName)
+      jsonRecords = []
 
-      # Convert temporary dictionary into JSON string
-      try:
-         resultJsonString = json.dumps(logData, sort_keys=True, indent=4, cls=JsonEncoder)
-         self.tracer.debug("[%s] resultJson=%s" % (self.fullName,
-                                                   str(resultJsonString)))
-      except Exception as e:
-         self.tracer.error("[%s] could not format logItem=%s into JSON (%s)" % (self.fullName,
-                                                                                logItem,
-                                                                                e))
-      return resultJsonString
+      # Only loop through the result if there is one
+      if self.lastResult:
+         (colIndex, resultRows) = self.lastResult
+         # Unless it's the column mapped to TimeGenerated, remove internal fields
+         columns = [(c, idx, self.lastResultEncoders[idx]) for (c, idx) in colIndex.items() \
+            if c == self.colTimeGenerated or not (c.startswith("_") or c == "DUMMY")]
+         encoder = JsonRowEncoder(columns,
+                                  {
+                                     "SAPMON_VERSION": PAYLOAD_VERSION,
+                                     "PROVIDER_INSTANCE": self.providerInstance.name,
+                                     "METADATA": self.providerInstance.metadata
+                                  })
+         try:
+            jsonRecords = [encoder.encode(r) for r in resultRows]
+            self.tracer.debug("[%s] resultJson=%s", self.fullName, TracePayload(jsonRecords))
+         except Exception as e:
+            self.tracer.error("[%s] could not format result into JSON (%s)" % (self.fullName,
+                                                                              e))
+      return jsonRecords
 
    # Update the internal state of this check (including last run times)
    def updateState(self) -> bool:
@@ -338,59 +663,81 @@ class saphanaProviderCheck(ProviderCheck):
       self.state["lastRunLocal"] = lastRunLocal
 
       # Only store lastRunServer if we have it in the check result; consider time-series queries
-      if len(resultRows) > 0:
+      # (if the query has an upper bound, it has fetched all records up to that bound, even if there were none)
+      if self.lastUpperBound:
+         self.state["lastRunServer"] = self.lastUpperBound
+      elif len(resultRows) > 0:
          if COL_TIMESERIES_UTC in colIndex:
             self.state["lastRunServer"] = resultRows[-1][colIndex[COL_TIMESERIES_UTC]]
          elif COL_SERVER_UTC in colIndex:
             self.state["lastRunServer"] = resultRows[0][colIndex[COL_SERVER_UTC]]
 
-      self.state["lastResultHash"] = self._calculateResultHash(resultRows)
+      self.state["lastResultHash"] = self._calculateResultHash(colIndex, resultRows)
       self.tracer.info("[%s] internal state successfully updated" % self.fullName)
       return True
 
    # Connect to HANA and run the check-specific SQL statement
+   # Time series queries can optionally have an upper bound ({upperBoundUtc}), so records that are still
+   # being written (safetyLagSecs) are not fetched yet and large backlogs are fetched in windows of maxWindowSecs
    def _actionExecuteSql(self,
                     sql: str,
                     isTimeSeries: bool = False,
-                    initialTimespanSecs: int = 60) -> None:
+                    initialTimespanSecs: int = 60,
+                    safetyLagSecs: int = 0,
+                    maxWindowSecs: Optional[int] = None,
+                    maxWindowsPerRun: int = MAX_WINDOWS_PER_RUN) -> None:
       self.tracer.info("[%s] connecting to HANA and executing SQL" % self.fullName)
 
       # Marking which column will be used for TimeGenerated
       self.colTimeGenerated = COL_TIMESERIES_UTC if isTimeSeries else COL_SERVER_UTC
 
-      # Find and connect to HANA server
-      (connection, cursor, host) = self._getHanaConnection()
-      if not connection:
-         raise Exception("Unable to get HANA connection")
-
       # Prepare SQL statement
-      preparedSql = self._prepareSql(sql,
-                                     isTimeSeries,
-                                     initialTimespanSecs)
+      (preparedSql, parameterNames) = self._prepareSql(sql,
+                                                       isTimeSeries)
       if not preparedSql:
          raise Exception("Unable to prepare SQL statement")
-
-      # Execute SQL statement
-      self.tracer.debug("[%s] executing SQL statement %s" % (self.fullName,
-                                                             preparedSql))
-      cursor.execute(preparedSql)
-      colIndex = {col[0] : idx for idx, col in enumerate(cursor.description)}
-      resultRows = cursor.fetchall()
+      hasUpperBound = SQL_PARAM_UPPER_BOUND in parameterNames
+      if (safetyLagSecs or maxWindowSecs) and not hasUpperBound:
+         self.tracer.warning("[%s] safetyLagSecs and maxWindowSecs require %s in the SQL statement" % (self.fullName,
+                                                                                                     SQL_PARAM_UPPER_BOUND))
+
+      # Borrow a connection to the HANA server from the pool of the provider instance and execute SQL statement
+      # (once per window of a time series query)
+      resultRows = []
+      self.lastUpperBound = None
+      with self.providerInstance.connectionPool.connection() as pooledConnection:
+         windows = [(None, None)]
+         if isTimeSeries:
+            windows = self._getTimeSeriesWindows(pooledConnection,
+                                                 hasUpperBound,
+                                                 initialTimespanSecs,
+                                                 safetyLagSecs,
+                                                 maxWindowSecs,
+                                                 maxWindowsPerRun)
+         for (lowerBound, upperBound) in windows:
+            boundValues = {SQL_PARAM_LOWER_BOUND: lowerBound, SQL_PARAM_UPPER_BOUND: upperBound}
+            parameters = [boundValues[name] for name in parameterNames]
+            self.tracer.debug("[%s] executing SQL statement %s with parameters %s on %s",
+                              self.fullName,
+                              TracePayload(preparedSql),
+                              parameters,
+                              pooledConnection.host)
+            (description, windowRows) = pooledConnection.executePrepared(preparedSql, parameters)
+            resultRows.extend(windowRows)
+         colIndex = {col[0] : idx for idx, col in enumerate(description)}
+         self.lastResultEncoders = getColumnEncoders([col[1] for col in description])
+      if hasUpperBound:
+         self.lastUpperBound = windows[-1][1]
 
       self.lastResult = (colIndex, resultRows)
-      self.tracer.debug("[%s] lastResult.colIndex=%s" % (self.fullName,
-                                                         colIndex))
-      self.tracer.debug("[%s] lastResult.resultRows=%s " % (self.fullName,
-                                                            resultRows))
+      if self.tracer.isEnabledFor(logging.DEBUG):
+         self.tracer.debug("[%s] lastResult.colIndex=%s", self.fullName, colIndex)
+         self.tracer.debug("[%s] lastResult.resultRows=%s ", self.fullName, TracePayload(resultRows))
 
       # Update internal state
       if not self.updateState():
          raise Exception("Failed to update state")
 
-      # Disconnect from HANA server to avoid memory leaks
-      self.tracer.debug("[%s] closing HANA connection" % self.fullName)
-      connection.close()
-
       self.tracer.info("[%s] successfully ran SQL for check" % self.fullName)
 
    # Parse result of the query against M_LANDSCAPE_HOST_CONFIGURATION and store it internally
@@ -408,17 +755,101 @@ class saphanaProviderCheck(ProviderCheck):
             "role": r["INDEXSERVER_ACTUAL_ROLE"]
             }
          hosts.append(host)
-      self.providerInstance.state["hostConfig"] = hosts
-      self.tracer.debug("hosts=%s" % hosts)
+      self.providerInstance.setState("hostConfig", hosts)
+      self.tracer.debug("hosts=%s", TracePayload(hosts))
+
+   # Probe a single HANA host and port; returns the latency (in ms) if the host is reachable
+   def _probeHost(self,
+                  host: str,
+                  port: int,
+                  probeTimeout: int,
+                  probeMode: str) -> Optional[float]:
+      self.tracer.debug("[%s] probing HANA connection at %s:%d (probeMode=%s)" % (self.fullName,
+                                                                                 host,
+                                                                                 port,
+                                                                                 probeMode))
+      startTime = time.time()
+
+      # Only verify that the port accepts TCP connections (no authentication handshake)
+      if probeMode == PROBE_MODE_TCP:
+         try:
+            with socket.create_connection((host, port), timeout = probeTimeout / 1000):
+               pass
+         except Exception as e:
+            self.tracer.warning("[%s] HANA host %s:%d is not responding to probe (%s)" % (self.fullName,
+                                                                                       host,
+                                                                                       port,
+                                                                                       e))
+            return None
+         return (time.time() - startTime) * 1000
+
+      try:
+         connection = self.providerInstance._establishHanaConnectionToHost(hostname = host,
+                                                                           port = port,
+                                                                           timeout = probeTimeout / 1000)
+         success = connection.isconnected()
+         if success:
+            self.tracer.debug("[%s] HANA connection successfully established" % self.fullName)
+            connection.close()
+      except Exception as e:
+         # We know that SQL connections to hdbnameserver will fail
+         # Let's determine if the HANA landscape is up, based on the error code
+         # (Note: this applies to scale-out landscapes with n+m nodes only)
+         msg = getattr(e, "errortext", str(e)).lower()
+         success = False
+         if "89008" in msg or "socket closed" in msg:
+            success = True
+            self.tracer.debug("[%s] received expected error probing HANA nameserver %s:%d (%s)" % (self.fullName,
+                                                                                                   host,
+                                                                                                   port,
+                                                                                                   e))
+         elif "89001" in msg or "cannot resolve host name" in msg \
+         or "89006" in msg or "connection refused" in msg \
+         or "timeout expired" in msg:
+            self.tracer.warning("[%s] HANA host %s:%d is not responding to probe (%s)" % (self.fullName,
+                                                                                       host,
+                                                                                       port,
+                                                                                       e))
+         else:
+            self.tracer.warning("[%s] unexpected error when probing HANA host %s:%d (%s)" % (self.fullName,
+                                                                                          host,
+                                                                                          port,
+                                                                                          e))
+      if not success:
+         return None
+      return (time.time() - startTime) * 1000
+
+   # Probe the SQL port of a host and, only if that fails, its nameserver port
+   # This Nameserver workaround is required, since in a n+m scale-out scenario (with m>0),
+   # stand-by nodes will have no hdbindexserver running, hence SQL connection will fail.
+   def _probeHostPorts(self,
+                       host: str,
+                       ports: List[int],
+                       probeTimeout: int,
+                       probeMode: str) -> Optional[float]:
+      for port in ports:
+         latency = self._probeHost(host, port, probeTimeout, probeMode)
+         if latency is not None:
+            return latency
+      return None
 
    # Probe SQL Connection to all nodes in HANA landscape
+   # All hosts are probed in parallel (bounded by maxParallelProbes) within an overall deadline;
+   # hosts whose probe did not finish in time are reported with an unknown status (SUCCESS is null)
    def _actionProbeSqlConnection(self,
-                                 probeTimeout: int = None) -> None:
+                                 probeTimeout: int = None,
+                                 probeMode: str = PROBE_MODE_SQL,
+                                 maxParallelProbes: int = PROBE_MAX_PARALLEL,
+                                 probeDeadline: int = None) -> None:
       self.tracer.info("[%s] probing SQL connection to all HANA nodes" % self.fullName)
 
       # If no probeTimeout parameter is defined for this action, use the default
       if probeTimeout is None:
          probeTimeout = TIMEOUT_HANA_MS
+      if probeDeadline is None:
+         probeDeadline = probeTimeout * PROBE_DEADLINE_FACTOR
+      if probeMode not in (PROBE_MODE_SQL, PROBE_MODE_TCP):
+         raise Exception("invalid probeMode %s" % probeMode)
 
       # For this check, the column storing the local UTC will be used for TimeGenerated
       self.colTimeGenerated = COL_LOCAL_UTC
@@ -427,62 +858,41 @@ class saphanaProviderCheck(ProviderCheck):
       if "hostConfig" not in self.providerInstance.state:
          raise Exception("HANA host config check has not been executed yet")
 
-      # Iterate through all hosts (alphabetical order) from the host config
+      # Given the SQL port (3xxyy), calculate hdbnameserver port (3xx01)
+      portSQL = self.providerInstance.hanaDbSqlPort
+      portNameserver = int(str(portSQL)[:-2] + "01")
+
+      # Probe connection to Indexserver (SQL) of each node, and its Nameserver if that fails
       hostConfig = self.providerInstance.state["hostConfig"]
-      hostsToProbe = [h["host"] for h in hostConfig]
+      hostsToProbe = sorted(h["host"] for h in hostConfig)
+      executor = ThreadPoolExecutor(max_workers = max(min(maxParallelProbes, len(hostsToProbe)), 1),
+                                    thread_name_prefix = "%s-probe" % self.providerInstance.name)
+      futures = {}
+      try:
+         futures = {executor.submit(self._probeHostPorts, host, [portSQL, portNameserver], probeTimeout, probeMode): host \
+            for host in hostsToProbe}
+         (_, notDone) = wait(futures.keys(), timeout = probeDeadline / 1000)
+      finally:
+         # Probes that have not started before the deadline are cancelled; running ones are abandoned
+         # (they end after their own probeTimeout)
+         for future in futures.keys():
+            future.cancel()
+         executor.shutdown(wait = False)
+      if notDone:
+         self.tracer.warning("[%s] probes of %d hosts did not finish within %dms (%s)" % (self.fullName,
+                                                                                        len(notDone),
+                                                                                        probeDeadline,
+                                                                                        ", ".join(sorted(futures[f] for f in notDone))))
+
+      # Build probing result tuple with current local time
+      # (a host is up if any of its ports is reachable; its status is unknown if its probe did not finish)
       probeResults = []
-      for host in sorted(hostsToProbe):
-         latency = None
-         success = False
-
-         # Given the SQL port (3xxyy), calculate hdbnameserver port (3xx01)
-         portSQL = self.providerInstance.hanaDbSqlPort
-         portNameserver = int(str(portSQL)[:-2] + "01")
-
-         for port in (portSQL, portNameserver):
-            # Probe connection to Indexserver (SQL) and Nameserver of a particular node
-            # This Nameserver workaround is required, since in a n+m scale-out scenario (with m>0),
-            # stand-by nodes will have no hdbindexserver running, hence SQL connection will fail.
-            startTime = time.time()
-            try:
-               self.tracer.debug("[%s] probing HANA connection at %s:%d" % (self.fullName,
-                                                                            host,
-                                                                            port))
-               connection = self.providerInstance._establishHanaConnectionToHost(hostname = host,
-                                                                                 port = port,
-                                                                                 timeout = probeTimeout)
-               if connection.isconnected():
-                  self.tracer.debug("[%s] HANA connection successfully established" % self.fullName)
-                  success = True
-                  connection.close()
-            except Exception as e:
-               # We know that SQL connections to hdbnameserver will fail
-               # Let's determine if the HANA landscape is up, based on the error code
-               # (Note: this applies to scale-out landscapes with n+m nodes only)
-               msg = e.errortext.lower()
-               if "89008" in msg or "socket closed" in msg:
-                  success = True
-                  self.tracer.debug("[%s] received expected error probing HANA nameserver %s:%d (%s" % (self.fullName,
-                                                                                                        host,
-                                                                                                        portNameserver,
-                                                                                                        e))
-               elif "89001" in msg or "cannot resolve host name" in msg \
-               or "89006" in msg or "connection refused" in msg \
-               or "timeout expired" in msg:
-                 self.tracer.warning("[%s] HANA nameserver %s:%d is not responding to probe (%s)" % (self.fullName,
-                                                                                                     host,
-                                                                                                     portNameserver,
-                                                                                                     e))
-               else:
-                 self.tracer.warning("[%s] unexpected error when probing HANA nameserver %s:%d (%s)" % (self.fullName,
-                                                                                                        host,
-                                                                                                        portNameserver,
-                                                                                                        e))
-            if success:
-               latency = (time.time() - startTime) * 1000
-               break
-
-         # Build probing result tuple with current local time
+      for (future, host) in sorted(futures.items(), key = lambda f: f[1]):
+         if future in notDone:
+            (success, latency) = (None, None)
+         else:
+            latency = future.result() if not future.exception() else None
+            success = latency is not None
          probeResults.append(
                [
                   datetime.utcnow(),
@@ -493,8 +903,7 @@ class saphanaProviderCheck(ProviderCheck):
             )
 
       # Store complete probing result internally and update state
-      self.tracer.debug("[%s] probeResults=%s" % (self.fullName,
-                                                  probeResults))
+      self.tracer.debug("[%s] probeResults=%s", self.fullName, TracePayload(probeResults))
       self.lastResult = (
             {
                COL_LOCAL_UTC: 0,
@@ -504,6 +913,7 @@ class saphanaProviderCheck(ProviderCheck):
             },
             probeResults
          )
+      self.lastResultEncoders = getColumnEncoders([datetime, str, bool, float])
 
       # Update internal state
       if not self.updateState():
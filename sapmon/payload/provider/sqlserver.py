@@ -1,8 +1,8 @@
 # Python modules
-import hashlib
 import json
 import logging
 import re
+import threading
 import time
 import pyodbc
 
@@ -12,7 +12,7 @@ from helper.azure import *
 from helper.context import *
 from helper.tools import *
 from provider.base import ProviderInstance, ProviderCheck
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 ###############################################################################
 
@@ -23,12 +23,109 @@ RETRY_RETRIES = 3
 RETRY_DELAY_SECS   = 1
 RETRY_BACKOFF_MULTIPLIER = 2
 
+# Default number of checks per provider instance that may run in parallel
+MAX_CONCURRENT_CHECKS = 4
+
+# Default connection pool settings
+POOL_MAX_LIFETIME_SECS = 3600
+POOL_LIVENESS_QUERY    = "SELECT 1"
+SQL_TYPE_VARIANT       = -150
+
+###############################################################################
+
+# Convert sql_variant columns (not supported by pyodbc) into strings
+def handleSqlVariantAsString(value: bytes) -> str:
+   return value.decode("utf-16le")
+
+# ODBC connection (and its cursor) managed by a connection pool
+class PooledSqlConnection:
+   def __init__(self,
+                connection: pyodbc.Connection):
+      self.connection = connection
+      self.cursor = connection.cursor()
+      self.createdTime = time.monotonic()
+      self.isBroken = False
+
+# Small pool of ODBC connections shared across all checks of a provider instance
+class SqlConnectionPool:
+   def __init__(self,
+                providerInstance: "MSSQLProviderInstance",
+                maxLifetimeSecs: int = POOL_MAX_LIFETIME_SECS):
+      self.providerInstance = providerInstance
+      self.tracer = providerInstance.tracer
+      self.maxLifetimeSecs = maxLifetimeSecs
+      self.idleConnections = []
+      self.lock = threading.Lock()
+
+   # Determine if a pooled connection is still alive and within its lifetime
+   def _isUsable(self,
+                 pooledConnection: PooledSqlConnection) -> bool:
+      if pooledConnection.isBroken:
+         return False
+      if time.monotonic() - pooledConnection.createdTime > self.maxLifetimeSecs:
+         self.tracer.debug("[%s] pooled sql connection exceeded max lifetime" % self.providerInstance.fullName)
+         return False
+      return True
+
+   # Run a trivial query to verify that the connection has not been dropped by the server
+   def _isAlive(self,
+                pooledConnection: PooledSqlConnection) -> bool:
+      try:
+         pooledConnection.cursor.execute(POOL_LIVENESS_QUERY)
+         pooledConnection.cursor.fetchall()
+         return True
+      except Exception as e:
+         self.tracer.debug("[%s] pooled sql connection is not alive (%s)" % (self.providerInstance.fullName, e))
+         return False
+
+   # Close a connection that is no longer used
+   def _close(self,
+              pooledConnection: PooledSqlConnection) -> None:
+      try:
+         pooledConnection.connection.close()
+      except Exception as e:
+         self.tracer.debug("[%s] could not close sql connection (%s)" % (self.providerInstance.fullName, e))
+
+   # Get a live connection from the pool or establish a new one
+   def acquire(self) -> PooledSqlConnection:
+      while True:
+         with self.lock:
+            if not self.idleConnections:
+               break
+            pooledConnection = self.idleConnections.pop()
+         if self._isUsable(pooledConnection) and self._isAlive(pooledConnection):
+            self.tracer.debug("[%s] reusing pooled sql connection" % self.providerInstance.fullName)
+            return pooledConnection
+         self._close(pooledConnection)
+
+      connection = self.providerInstance._establishSqlConnectionToHost()
+      connection.add_output_converter(SQL_TYPE_VARIANT, handleSqlVariantAsString)
+      return PooledSqlConnection(connection)
+
+   # Return a connection to the pool (unless it is broken or too old)
+   def release(self,
+               pooledConnection: PooledSqlConnection) -> None:
+      if not self._isUsable(pooledConnection):
+         self._close(pooledConnection)
+         return
+      with self.lock:
+         self.idleConnections.append(pooledConnection)
+
+   # Close all idle connections
+   def closeAll(self) -> None:
+      with self.lock:
+         idleConnections = self.idleConnections
+         self.idleConnections = []
+      for pooledConnection in idleConnections:
+         self._close(pooledConnection)
+
 ###############################################################################
 
 class MSSQLProviderInstance(ProviderInstance):
    sqlHostname = None
    sqlUsername = None
    sqlPassword = None
+   connectionPool = None
 
    def __init__(self,
                 tracer: logging.Logger,
@@ -48,7 +145,10 @@ class MSSQLProviderInstance(ProviderInstance):
                        providerInstance,
                        retrySettings,
                        skipContent,
+                       maxConcurrentChecks = MAX_CONCURRENT_CHECKS,
                        **kwargs)
+      self.connectionPool = SqlConnectionPool(self,
+                                              maxLifetimeSecs = self.providerProperties.get("sqlConnectionMaxLifetimeSecs", POOL_MAX_LIFETIME_SECS))
 
    # Parse provider properties and fetch DB password from KeyVault, if necessary
    def parseProperties(self):
@@ -111,120 +211,162 @@ class MSSQLProviderInstance(ProviderInstance):
                             timeout=TIMEOUT_SQL_SECS)
       return conn
 
+   # Close all pooled sql connections
+   def close(self) -> None:
+      self.connectionPool.closeAll()
+      super().close()
+
 ###############################################################################
 
 # Implements a SAP sql-specific monitoring check
 class MSSQLProviderCheck(ProviderCheck):
    lastResult = None
+   lastResultEncoders = []
    colTimeGenerated = None
+   pooledConnection = None
 
    def __init__(self,
                 provider: ProviderInstance,
                 **kwargs):
       return super().__init__(provider, **kwargs)
 
-   # Obtain one working sql connection
+   # Run all actions of this check on one shared connection, which is returned to the pool afterwards
+   def run(self) -> List[str]:
+      try:
+         return super().run()
+      finally:
+         self._releaseSqlConnection()
+
+   # Obtain one working sql connection (shared by all actions of this check)
    def _getSqlConnection(self):
+      if self.pooledConnection:
+         return self.pooledConnection
       self.tracer.info("[%s] establishing connection with sql instance" % self.fullName)
 
       try:
-        connection = self.providerInstance._establishSqlConnectionToHost()
-        cursor = connection.cursor()
+        self.pooledConnection = self.providerInstance.connectionPool.acquire()
       except Exception as e:
          self.tracer.warning("[%s] could not connect to sql (%s) " % (self.fullName,e))
          return (None)
-      return (connection)
+      return (self.pooledConnection)
+
+   # Return the shared connection to the pool of the provider instance
+   def _releaseSqlConnection(self) -> None:
+      if self.pooledConnection:
+         self.providerInstance.connectionPool.release(self.pooledConnection)
+         self.pooledConnection = None
 
-   # Calculate the MD5 hash of a result set
+   # Calculate the digest of a result set (only internal columns, e.g. timestamps of the query, are ignored)
    def _calculateResultHash(self,
-                            resultRows: List[List[str]]) -> str:
+                            colIndex: Dict[str, int],
+                            resultRows: List[List[object]]) -> str:
       self.tracer.info("[%s] calculating hash of SQL query result" % self.fullName)
       if len(resultRows) == 0:
          self.tracer.debug("[%s] result set is empty" % self.fullName)
          return None
       resultHash = None
       try:
-         resultHash = hashlib.md5(str(resultRows).encode("utf-8")).hexdigest()
-         self.tracer.debug("resultHash=%s" % resultHash)
+         columnIndices = [idx for (c, idx) in colIndex.items() if not (c.startswith("_") or c == "DUMMY")]
+         resultHash = calculateResultDigest(resultRows, columnIndices)
+         self.tracer.debug("[%s] resultHash=%s", self.fullName, resultHash)
       except Exception as e:
-         self.tracer.error("[%s] could not calculate result hash (%s)" % (self.fullName,e))
+         self.tracer.error("[%s] could not calculate result hash (%s)" % (self.fullName,
+                                                                          e))
       return resultHash
 
-   # Generate a JSON-encoded string with the last query result
-   # This string will be ingested into Log Analytics and Customer Analytics
-   def generateJsonString(self) -> str:
-      self.tracer.info("[%s] converting SQL query result set into JSON format" % self.fullName)
-      logData = []
+   # Get the hash of the last query result (used to detect unchanged results)
+   def getResultHash(self) -> Optional[str]:
+      return self.state.get("lastResultHash", None)
 
-      # Only loop through the result if there is one
+   # Get the key and fingerprint of each row of the last query result (in the same order as the records)
+   def generateRowFingerprints(self) -> Optional[List[Tuple[str, str]]]:
+      if not self.lastResult:
+         return None
+      (colIndex, resultRows) = self.lastResult
+      keyIndices = [colIndex[c] for c in self.deltaKeyColumns]
+      columnIndices = [idx for (c, idx) in colIndex.items() if not (c.startswith("_") or c == "DUMMY")]
+      return calculateRowFingerprints(resultRows, keyIndices, columnIndices)
+
+   # Convert the last query result into records (one dictionary per row)
+   def generateRecords(self) -> List[Dict]:
+      records = []
       if self.lastResult:
          (colIndex, resultRows) = self.lastResult
-         
-         # Iterate through all rows of the last query result
+         # Unless it's the column mapped to TimeGenerated, remove internal fields
+         columns = [(c, idx) for (c, idx) in colIndex.items() \
+            if c == self.colTimeGenerated or not (c.startswith("_") or c == "DUMMY")]
          for r in resultRows:
-            logItem = {
+            record = {
                "SAPMON_VERSION": PAYLOAD_VERSION,
                "PROVIDER_INSTANCE": self.providerInstance.name,
                "METADATA": self.providerInstance.metadata
             }
-            for c in colIndex.keys():
-               # Unless it's the column mapped to TimeGenerated, remove internal fields
-               if c != self.colTimeGenerated and (c.startswith("_") or c == "DUMMY"):
-                  continue
-               logItem[c] = r[colIndex[c]]
-            logData.append(logItem)
-
-      # Convert temporary dictionary into JSON string
-      try:
-         resultJsonString = json.dumps(logData, sort_keys=True, indent=4, cls=JsonEncoder)
-         self.tracer.debug("[%s] resultJson=%s" % (self.fullName,
-                                                   str(resultJsonString)))
-      except Exception as e:
-         self.tracer.error("[%s] could not format logItem=%s into JSON (%s)" % (self.fullName,
-                                                                                logItem,
-                                                                                e))
-      return resultJsonString
+            for (c, idx) in columns:
+               record[c] = r[idx]
+            records.append(record)
+      return records
+
+   # Encode the last query result into JSON records (one per row), without building a dictionary per row
+   # These records will be ingested into Log Analytics and Customer Analytics
+   def generateJsonRecords(self) -> List[str]:
+      self.tracer.info("[%s] converting SQL query result set into JSON format" % self.fullName)
+      jsonRecords = []
+
+      # Only loop through the result if there is one
+      if self.lastResult:
+         (colIndex, resultRows) = self.lastResult
+         # Unless it's the column mapped to TimeGenerated, remove internal fields
+         columns = [(c, idx, self.lastResultEncoders[idx]) for (c, idx) in colIndex.items() \
+            if c == self.colTimeGenerated or not (c.startswith("_") or c == "DUMMY")]
+         encoder = JsonRowEncoder(columns,
+                                  {
+                                     "SAPMON_VERSION": PAYLOAD_VERSION,
+                                     "PROVIDER_INSTANCE": self.providerInstance.name,
+                                     "METADATA": self.providerInstance.metadata
+                                  })
+         try:
+            jsonRecords = [encoder.encode(r) for r in resultRows]
+            self.tracer.debug("[%s] resultJson=%s", self.fullName, TracePayload(jsonRecords))
+         except Exception as e:
+            self.tracer.error("[%s] could not format result into JSON (%s)" % (self.fullName,
+                                                                              e))
+      return jsonRecords
 
    # Connect to sql and run the check-specific SQL statement
    def _actionExecuteSql(self, sql: str) -> None:
-      def handle_sql_variant_as_string(value):
-         return value.decode('utf-16le')
       self.tracer.info("[%s] connecting to sql and executing SQL" % self.fullName)
 
       # Find and connect to sql server
-      connection = self._getSqlConnection()
-      if not connection:
+      pooledConnection = self._getSqlConnection()
+      if not pooledConnection:
          raise Exception("Unable to get SQL connection")
 
-      cursor = connection.cursor()
-      connection.add_output_converter(-150, handle_sql_variant_as_string)
+      cursor = pooledConnection.cursor
 
       # Execute SQL statement
       try:
-         self.tracer.debug("[%s] executing SQL statement %s" % (self.fullName, sql))
+         self.tracer.debug("[%s] executing SQL statement %s", self.fullName, TracePayload(sql))
          cursor.execute(sql)
 
          colIndex = {col[0] : idx for idx, col in enumerate(cursor.description)}
+         self.lastResultEncoders = getColumnEncoders([col[1] for col in cursor.description])
          resultRows = cursor.fetchall()
 
       except Exception as e:
+         # Don't reuse this connection; a retry of this action will reconnect
+         pooledConnection.isBroken = True
+         self._releaseSqlConnection()
          raise Exception("[%s] could not execute SQL (%s)" % (self.fullName,e))
 
       self.lastResult = (colIndex, resultRows)
-      self.tracer.debug("[%s] lastResult.colIndex=%s" % (self.fullName,colIndex))
-      self.tracer.debug("[%s] lastResult.resultRows=%s " % (self.fullName,resultRows))
+      if self.tracer.isEnabledFor(logging.DEBUG):
+         self.tracer.debug("[%s] lastResult.colIndex=%s", self.fullName, colIndex)
+         self.tracer.debug("[%s] lastResult.resultRows=%s ", self.fullName, TracePayload(resultRows))
 
       # Update internal state
       if not self.updateState():
          raise Exception("Failed to update state")
 
-      # Disconnect from sql server to avoid memory leaks
-      try:
-         self.tracer.debug("[%s] closing sql connection" % self.fullName)
-         connection.close()
-      except Exception as e:
-         raise Exception("[%s] could not close connection to sql instance (%s)" % (self.fullName,e))
-
       self.tracer.info("[%s] successfully ran SQL for check" % self.fullName)
 
 # Update the internal state of this check (including last run times)
@@ -234,5 +376,8 @@ class MSSQLProviderCheck(ProviderCheck):
       # Always store lastRunLocal; 
       lastRunLocal = datetime.utcnow()
       self.state["lastRunLocal"] = lastRunLocal
+
+      (colIndex, resultRows) = self.lastResult
+      self.state["lastResultHash"] = self._calculateResultHash(colIndex, resultRows)
       self.tracer.info("[%s] internal state successfully updated" % self.fullName)
       return True
@@ -9,13 +9,18 @@
 # Python modules
 from abc import ABC, abstractmethod
 import argparse
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
 import json
 import os
 import re
+import signal
 import sys
 import threading
+import time
 import traceback
 
+startupTime = time.perf_counter()
+
 # Payload modules
 from const import *
 from helper.azure import *
@@ -23,9 +28,13 @@ from helper.context import Context
 from helper.tools import *
 from helper.tracing import *
 from helper.providerfactory import *
+from helper.scheduler import CheckScheduler
 from helper.updateprofile import *
 from helper.updatefactory import *
 
+startupBenchmark = StartupBenchmark(startupTime)
+startupBenchmark.endPhase("imports")
+
 ###############################################################################
 
 class ProviderInstanceThread(threading.Thread):
@@ -34,43 +43,75 @@ class ProviderInstanceThread(threading.Thread):
       self.providerInstance = providerInstance
 
    def run(self):
-      global ctx, tracer
-      for check in self.providerInstance.checks:
-         tracer.info("starting check %s" % (check.fullName))
+      global tracer
+      # Checks of this instance are executed by a bounded pool, so slow checks don't delay the others;
+      # checks that depend on other checks run in a later stage (their state is committed at once when
+      # the instance is closed)
+      maxConcurrentChecks = self.providerInstance.getMaxConcurrentChecks()
+      tracer.debug("running checks of %s with up to %d workers" % (self.providerInstance.fullName,
+                                                                   maxConcurrentChecks))
+      with ThreadPoolExecutor(max_workers = maxConcurrentChecks,
+                              thread_name_prefix = self.providerInstance.name) as executor:
+         for stage in self.providerInstance.getCheckStages(self.providerInstance.checks):
+            futures = {executor.submit(runCheck, check): check for check in stage}
+            for future in as_completed(futures):
+               try:
+                  future.result()
+               except Exception as e:
+                  tracer.error("unhandled error in check %s (%s)" % (futures[future].fullName, e))
+      # Post the buffered results first, so their ingestion state is committed along with the instance
+      ctx.azLa.flush()
+      self.providerInstance.close()
+      return
 
-         # Skip this check if it's not enabled or not due yet
-         if (check.isEnabled() == False) or (check.isDue() == False):
-            continue
+###############################################################################
+
+# Execute a single check (if enabled and due) and ingest its result
+# Checks dispatched by the scheduler (daemon mode) are due by definition
+def runCheck(check: ProviderCheck,
+             scheduled: bool = False) -> None:
+   global ctx, tracer
+   tracer.info("starting check %s" % (check.fullName))
 
-         # Run all actions that are part of this check
-         resultJson = check.run()
-
-         # Ingest result into Log Analytics
-         ctx.azLa.ingest(check.customLog,
-                         resultJson,
-                         check.colTimeGenerated)
-
-         # Persist updated internal state to provider state file
-         self.providerInstance.writeState()
-
-         # Ingest result into Customer Analytics
-         enableCustomerAnalytics = ctx.globalParams.get("enableCustomerAnalytics", True)
-         if enableCustomerAnalytics and check.includeInCustomerAnalytics:
-             tracing.ingestCustomerAnalytics(tracer,
-                                             ctx,
-                                             check.customLog,
-                                             resultJson)
-         tracer.info("finished check %s" % (check.fullName))
+   # Skip this check if it's not enabled or not due yet
+   if (check.isEnabled() == False) or (not scheduled and check.isDue() == False):
       return
 
+   # Run all actions that are part of this check
+   resultRecords = check.run()
+
+   # Ingest result into Log Analytics (only the records selected by the ingest policy of the check)
+   ctx.azLa.ingestRecords(check.customLog,
+                          check.selectRecordsToIngest(resultRecords),
+                          check.colTimeGenerated,
+                          onIngested = check.getIngestCallback())
+
+   # Stage updated internal state; it is committed to the state store at the end of the scheduling round
+   check.providerInstance.stageState([check])
+
+   # Ingest result into Customer Analytics
+   enableCustomerAnalytics = ctx.globalParams.get("enableCustomerAnalytics", True)
+   if enableCustomerAnalytics and check.includeInCustomerAnalytics:
+       tracing.ingestCustomerAnalytics(tracer,
+                                       ctx,
+                                       check.customLog,
+                                       resultRecords)
+   tracer.info("finished check %s" % (check.fullName))
+   return
+
 ###############################################################################
 
 # Load entire config from KeyVault (global parameters and provider instances)
-def loadConfig() -> bool:
+# Provider instances whose secret has not changed since the last load are kept as-is
+# Before a changed provider instance is replaced, retireInstance is called with the current instance
+def loadConfig(retireInstance: Optional[Callable[[ProviderInstance], None]] = None) -> bool:
    global ctx, tracer
    tracer.info("loading config from KeyVault")
 
    secrets = ctx.azKv.getCurrentSecrets()
+   loadedInstances = {i.name: i for i in ctx.instances}
+   globalParams = {}
+   instances = []
    for secretName in secrets.keys():
       tracer.debug("parsing KeyVault secret %s" % secretName)
       secretValue = secrets[secretName]
@@ -81,11 +122,18 @@ def loadConfig() -> bool:
                                                                   e))
          continue
       if secretName == CONFIG_SECTION_GLOBAL:
-         ctx.globalParams = providerProperties
+         globalParams = providerProperties
          tracer.debug("successfully loaded global config")
       else:
          instanceName = providerProperties.get("name", None)
          providerType = providerProperties.get("type", None)
+         if instanceName in loadedInstances and ctx.configSecrets.get(secretName, None) == secretValue:
+            tracer.debug("config for provider instance %s is unchanged" % instanceName)
+            instances.append(loadedInstances[instanceName])
+            continue
+         # The replacement has to start from the latest state of the current instance
+         if instanceName in loadedInstances and retireInstance:
+            retireInstance(loadedInstances[instanceName])
          try:
             providerInstance = ProviderFactory.makeProviderInstance(providerType,
                                                                     tracer,
@@ -96,11 +144,48 @@ def loadConfig() -> bool:
             tracer.error("could not validate provider instance %s (%s)" % (instanceName,
                                                                            e))
             continue
-         ctx.instances.append(providerInstance)
+         instances.append(providerInstance)
          tracer.debug("successfully loaded config for provider instance %s" % instanceName)
-   if ctx.globalParams == {} or len(ctx.instances) == 0:
+   if globalParams == {} or len(instances) == 0:
       tracer.error("did not find any provider instances in KeyVault")
       return False
+   ctx.globalParams = globalParams
+   ctx.instances = instances
+   maxTracePayloadBytes = globalParams.get("maxTracePayloadBytes", DEFAULT_TRACE_PAYLOAD_MAX_BYTES)
+   try:
+      maxTracePayloadBytes = int(maxTracePayloadBytes)
+      if maxTracePayloadBytes <= 0:
+         raise ValueError("maxTracePayloadBytes must be positive")
+   except (TypeError, ValueError):
+      tracer.error("invalid value maxTracePayloadBytes=%s, using %d" % (maxTracePayloadBytes,
+                                                                        DEFAULT_TRACE_PAYLOAD_MAX_BYTES))
+      maxTracePayloadBytes = DEFAULT_TRACE_PAYLOAD_MAX_BYTES
+   TracePayload.maxBytes = maxTracePayloadBytes
+   ctx.configSecrets = secrets
+   return True
+
+# Connect to the Log Analytics workspace configured in the global parameters
+def initLogAnalytics() -> bool:
+   global ctx, tracer
+   logAnalyticsWorkspaceId = ctx.globalParams.get("logAnalyticsWorkspaceId", None)
+   logAnalyticsSharedKey = ctx.globalParams.get("logAnalyticsSharedKey", None)
+   if not logAnalyticsWorkspaceId or not logAnalyticsSharedKey:
+      tracer.critical("global config must contain logAnalyticsWorkspaceId and logAnalyticsSharedKey")
+      return False
+   # Keep the current client (and everything it has buffered) if the workspace has not changed
+   previousLa = ctx.azLa
+   if previousLa and previousLa.workspaceId == logAnalyticsWorkspaceId and previousLa.sharedKey == logAnalyticsSharedKey:
+      return True
+   ctx.azLa = AzureLogAnalytics(tracer,
+                                logAnalyticsWorkspaceId,
+                                logAnalyticsSharedKey,
+                                compress = ctx.globalParams.get("logAnalyticsCompression", False),
+                                flushBytes = ctx.globalParams.get("logAnalyticsFlushBytes", LOG_ANALYTICS_FLUSH_BYTES),
+                                flushSecs = ctx.globalParams.get("logAnalyticsFlushSecs", LOG_ANALYTICS_FLUSH_SECS))
+   # Only then ingest everything that is still buffered for the previous workspace
+   # (checks that still hold the previous client have their records posted right away)
+   if previousLa:
+      previousLa.close()
    return True
 
 # Save specific instance properties to customer KeyVault
@@ -179,17 +264,16 @@ def deleteProvider(args: str) -> None:
    global ctx, tracer
    tracer.info("retrieving provider list from KeyVault")
 
-   # Clean up state file
-   fileToDelete = "%s.state" % args.name
+   # Clean up state store (and state file of earlier versions)
+   filesToDelete = ["%s.state%s" % (args.name, suffix) for suffix in ("", ".db", ".db-wal", ".db-shm")]
    found = False
    for f in os.listdir(PATH_STATE):
-      if f == fileToDelete:
+      if f in filesToDelete:
          os.remove(os.path.join(PATH_STATE, f))
-         tracer.info("state file %s successfully deleted" % fileToDelete)
+         tracer.info("state file %s successfully deleted" % f)
          found = True
-         break
    if not found:
-      tracer.error("state file %s not found" % fileToDelete)
+      tracer.error("state file for %s not found" % args.name)
 
    # Delete corresponding secret from KeyVault
    secretToDelete = args.name
@@ -206,20 +290,17 @@ def deleteProvider(args: str) -> None:
 # Execute the actual monitoring payload
 def monitor(args: str) -> None:
    global ctx, tracer
+   if args.daemon:
+      monitorDaemon(args)
+      return
    tracer.info("starting monitor payload")
 
    threads = []
    if not loadConfig():
       tracer.critical("failed to load config from KeyVault")
       sys.exit(ERROR_LOADING_CONFIG)
-   logAnalyticsWorkspaceId = ctx.globalParams.get("logAnalyticsWorkspaceId", None)
-   logAnalyticsSharedKey = ctx.globalParams.get("logAnalyticsSharedKey", None)
-   if not logAnalyticsWorkspaceId or not logAnalyticsSharedKey:
-      tracer.critical("global config must contain logAnalyticsWorkspaceId and logAnalyticsSharedKey")
+   if not initLogAnalytics():
       sys.exit(ERROR_GETTING_LOG_CREDENTIALS)
-   ctx.azLa = AzureLogAnalytics(tracer,
-                                logAnalyticsWorkspaceId,
-                                logAnalyticsSharedKey)
    for i in ctx.instances:
       thread = ProviderInstanceThread(i)
       thread.start()
@@ -227,10 +308,182 @@ def monitor(args: str) -> None:
 
    for t in threads:
       t.join()
+   ctx.azLa.close()
 
    tracer.info("monitor payload successfully completed")
    return
 
+# Execute the monitoring payload as a long-running process
+# Context and provider instances are only built once; config is refreshed every configRefreshSecs
+def monitorDaemon(args: str) -> None:
+   global ctx, tracer
+   tracer.info("starting monitor payload in daemon mode (configRefreshSecs=%d)" % args.configRefreshSecs)
+
+   stopEvent = threading.Event()
+   def onSignal(signum, frame):
+      tracer.info("received signal %d, stopping monitor payload" % signum)
+      stopEvent.set()
+   signal.signal(signal.SIGTERM, onSignal)
+   signal.signal(signal.SIGINT, onSignal)
+
+   if not loadConfig():
+      tracer.critical("failed to load config from KeyVault")
+      sys.exit(ERROR_LOADING_CONFIG)
+   if not initLogAnalytics():
+      sys.exit(ERROR_GETTING_LOG_CREDENTIALS)
+   nextConfigRefresh = time.time() + args.configRefreshSecs
+
+   # Checks of the same provider instance are executed by a bounded worker pool of that instance,
+   # so a slow check never delays the scheduler itself
+   scheduler = CheckScheduler(tracer)
+   scheduler.update([check for i in ctx.instances for check in i.checks])
+   executors = {}
+   runningChecks = set()
+   runningChecksLock = threading.Lock()
+
+   def runScheduledCheck(check: ProviderCheck) -> None:
+      try:
+         runCheck(check, scheduled = True)
+      except Exception as e:
+         tracer.error("unhandled error in check %s (%s)" % (check.fullName, e))
+      finally:
+         with runningChecksLock:
+            runningChecks.discard(check)
+
+   # Commit the staged state of all provider instances of a scheduling round at once,
+   # as soon as the last check of that round has finished
+   def commitStateAfterRound(roundChecks: Dict[ProviderCheck, Future]) -> None:
+      roundInstances = set(check.providerInstance for check in roundChecks.keys())
+      remainingChecks = [len(roundChecks)]
+      remainingChecksLock = threading.Lock()
+      def onCheckDone(future: Future) -> None:
+         with remainingChecksLock:
+            remainingChecks[0] -= 1
+            if remainingChecks[0] > 0:
+               return
+         for providerInstance in roundInstances:
+            providerInstance.commitState()
+      for future in roundChecks.values():
+         future.add_done_callback(onCheckDone)
+
+   # Submit the checks of a provider instance stage by stage; a stage is only submitted once all checks
+   # of the previous stage have finished (returns a future per check, which is done once the check has run)
+   def submitInStages(executor: ThreadPoolExecutor,
+                      stages: List[List[ProviderCheck]]) -> Dict[ProviderCheck, Future]:
+      futures = {check: Future() for stage in stages for check in stage}
+      def submitStage(stageIdx: int) -> None:
+         if stageIdx >= len(stages):
+            return
+         remainingChecks = [len(stages[stageIdx])]
+         remainingChecksLock = threading.Lock()
+         def onCheckDone(check: ProviderCheck) -> None:
+            with remainingChecksLock:
+               remainingChecks[0] -= 1
+               isLastCheck = remainingChecks[0] == 0
+            if isLastCheck:
+               submitStage(stageIdx + 1)
+            futures[check].set_result(None)
+         for check in stages[stageIdx]:
+            try:
+               executor.submit(runScheduledCheck, check).add_done_callback(lambda _, check = check: onCheckDone(check))
+            except RuntimeError:
+               # The executor has been shut down in the meantime (the provider instance has been replaced)
+               with runningChecksLock:
+                  runningChecks.discard(check)
+               onCheckDone(check)
+      submitStage(0)
+      return futures
+
+   # Let the running checks of a provider instance that is about to be replaced finish, then commit its state
+   # and close it (blocks the scheduler, but only if the config of an instance has changed)
+   retiredInstances = set()
+   def retireInstance(providerInstance: ProviderInstance) -> None:
+      tracer.info("retiring provider instance %s before replacing it" % providerInstance.fullName)
+      if providerInstance in executors:
+         executors.pop(providerInstance)[0].shutdown(wait = True)
+      ctx.azLa.flush()
+      providerInstance.close()
+      retiredInstances.add(providerInstance)
+
+   # Close provider instances once the checks that are still running on their (old) executors have finished
+   # (in the background, so the scheduler is not blocked by slow checks)
+   def closeWhenIdle(retiredExecutors: List[ThreadPoolExecutor],
+                     retiredInstances: List[ProviderInstance]) -> None:
+      def closeRetired() -> None:
+         for executor in retiredExecutors:
+            executor.shutdown(wait = True)
+         ctx.azLa.flush()
+         for providerInstance in retiredInstances:
+            providerInstance.close()
+      if retiredExecutors or retiredInstances:
+         threading.Thread(target = closeRetired,
+                          name = "CloseRetiredInstances",
+                          daemon = True).start()
+
+   while not stopEvent.is_set():
+      # Refresh config from KeyVault; keep the previous config if this fails
+      if time.time() >= nextConfigRefresh:
+         tracer.info("refreshing config from KeyVault")
+         previousInstances = ctx.instances
+         if not loadConfig(retireInstance) or not initLogAnalytics():
+            tracer.error("failed to refresh config from KeyVault, keeping previous config")
+         scheduler.update([check for i in ctx.instances for check in i.checks])
+         retiredExecutors = []
+         for i in list(executors.keys()):
+            if i not in ctx.instances or executors[i][1] != i.getMaxConcurrentChecks():
+               retiredExecutors.append(executors.pop(i)[0])
+         closeWhenIdle(retiredExecutors,
+                       [i for i in previousInstances if i not in ctx.instances and i not in retiredInstances])
+         retiredInstances.clear()
+         nextConfigRefresh = time.time() + args.configRefreshSecs
+
+      # Hand over all checks that are due to the worker of their provider instance
+      # Checks that depend on other checks of this round run after them; checks that depend on checks
+      # which have never run yet are skipped until those have run
+      dueChecks = {}
+      for check in scheduler.popDueChecks():
+         with runningChecksLock:
+            if check in runningChecks:
+               tracer.warning("check %s is still running, skipping this run" % check.fullName)
+               continue
+         dueChecks.setdefault(check.providerInstance, []).append(check)
+      roundChecks = {}
+      for (providerInstance, checks) in dueChecks.items():
+         for check in list(checks):
+            unmetDependencies = providerInstance.getUnmetDependencies(check, checks)
+            if unmetDependencies:
+               tracer.info("check %s depends on %s, which has not run yet, skipping this run" % (check.fullName,
+                                                                                                ", ".join(unmetDependencies)))
+               checks.remove(check)
+         with runningChecksLock:
+            runningChecks.update(checks)
+         if providerInstance not in executors:
+            maxConcurrentChecks = providerInstance.getMaxConcurrentChecks()
+            executor = ThreadPoolExecutor(max_workers = maxConcurrentChecks,
+                                          thread_name_prefix = providerInstance.name)
+            executors[providerInstance] = (executor, maxConcurrentChecks)
+         roundChecks.update(submitInStages(executors[providerInstance][0],
+                                           providerInstance.getCheckStages(checks)))
+      if roundChecks:
+         commitStateAfterRound(roundChecks)
+
+      # Sleep exactly until the next check is due (or the config has to be refreshed)
+      waitSecs = nextConfigRefresh - time.time()
+      secsUntilNextDue = scheduler.getSecondsUntilNextDue()
+      if secsUntilNextDue is not None:
+         waitSecs = min(waitSecs, secsUntilNextDue)
+      tracer.debug("waiting %.3fs until next check is due" % max(waitSecs, 0))
+      stopEvent.wait(max(waitSecs, 0))
+
+   for (executor, _) in executors.values():
+      executor.shutdown(wait = True)
+   ctx.azLa.flush()
+   for i in ctx.instances:
+      i.close()
+   ctx.azLa.close()
+   tracer.info("monitor payload successfully stopped")
+   return
+
 # prepareUpdate will prepare the resources like keyvault, log analytics etc for the version passed as an argument
 # prepareUpdate needs to be run when a version upgrade requires specific update to the content of the resources
 def prepareUpdate(args: str) -> None:
@@ -271,6 +524,21 @@ def main() -> None:
 
    # Build the argument parser
    parser = argparse.ArgumentParser(description = "SAP Monitor Payload")
+   parser.add_argument("--httpPoolConnections",
+                       required = False,
+                       type = int,
+                       default = HTTP_POOL_CONNECTIONS,
+                       help = "number of hosts for which HTTP connections are kept alive")
+   parser.add_argument("--httpPoolMaxSize",
+                       required = False,
+                       type = int,
+                       default = HTTP_POOL_MAXSIZE,
+                       help = "maximum number of HTTP connections that are kept alive per host")
+   parser.add_argument("--httpRetries",
+                       required = False,
+                       type = int,
+                       default = HTTP_RETRIES,
+                       help = "number of retries of failed HTTP requests")
    subParsers = parser.add_subparsers(title = "actions",
                                       help = "Select action to run")
    subParsers.required = True
@@ -320,6 +588,16 @@ def main() -> None:
    monParser = subParsers.add_parser("monitor",
                                       description = "Monitoring payload",
                                       help = "Execute the monitoring payload")
+   monParser.add_argument("--daemon",
+                          required = False,
+                          action = "store_true",
+                          dest = "daemon",
+                          help = "run as long-running process with an internal check scheduler")
+   monParser.add_argument("--configRefreshSecs",
+                          required = False,
+                          type = int,
+                          default = DEFAULT_CONFIG_REFRESH_SECS,
+                          help = "interval in which the config is reloaded from KeyVault (daemon mode only)")
    addVerboseToParser(monParser)
    monParser.set_defaults(func = monitor)
 
@@ -361,8 +639,16 @@ def main() -> None:
    updParser.set_defaults(func = prepareUpdate)
 
    args = parser.parse_args()
+   # The shared HTTP session is created here, before any request is sent
+   HttpSession(poolConnections = max(args.httpPoolConnections, 1),
+               poolMaxSize = max(args.httpPoolMaxSize, 1),
+               retries = max(args.httpRetries, 0))
+   startupBenchmark.endPhase("arguments")
    tracer = tracing.initTracer(args)
+   startupBenchmark.endPhase("tracer")
    ctx = Context(tracer, args.command)
+   startupBenchmark.endPhase("context")
+   startupBenchmark.report(tracer)
    args.func(args)
    return
 